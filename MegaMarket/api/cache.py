@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from typing import Any, Iterable
+
+from pydantic import BaseSettings
+
+
+class CacheSettings(BaseSettings):
+    """Настройки кэша ответов /nodes, читаются из переменных окружения с префиксом NODES_CACHE_"""
+    max_size: int = 1024  # Сколько ответов хранить в воркере, 0 - кэш выключен
+    reconnect_interval: float = 1.0  # Через сколько секунд переподключать потерянный LISTEN инвалидаций
+
+    class Config:
+        env_prefix = "NODES_CACHE_"
+
+
+INVALIDATION_CHANNEL = "nodes_cache_invalidation"  # Канал NOTIFY, по которому воркеры сообщают об изменениях
+MAX_INVALIDATION_PAYLOAD = 7900  # Payload NOTIFY ограничен 8000 байт, в больший список id не поместится
+
+
+def make_invalidation_message(keys: Iterable[str] | None) -> str:
+    """
+    Сообщение для других воркеров: id юнитов через запятую или * (сбросить кэш целиком),
+    если ключи неизвестны или их список не помещается в NOTIFY
+    """
+    if keys is None:
+        return "*"
+    message: str = ",".join(keys)
+    return message if len(message) <= MAX_INVALIDATION_PAYLOAD else "*"
+
+
+class ResponseCache:
+    """
+    LRU кэш сериализованных ответов по id юнита в памяти воркера.
+    generation растёт при каждой инвалидации: ответ, который начали собирать до неё,
+    мог прочитать из БД уже устаревшие данные, поэтому put его не сохранит.
+    Изменения, сделанные другими воркерами, приходят через NOTIFY и применяются apply_message
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size: int = max_size
+        self.items: OrderedDict[str, bytes] = OrderedDict()
+        self.generation: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.invalidations: int = 0
+
+    def get(self, key: str) -> bytes | None:
+        body: bytes | None = self.items.get(key)
+        if body is None:
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return body
+
+    def put(self, key: str, body: bytes, generation: int) -> None:
+        """Сохраняет ответ, если с момента generation, взятого до чтения из БД, не было инвалидаций"""
+        if self.max_size <= 0 or generation != self.generation:
+            return
+        self.items[key] = body
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, keys: Iterable[str]) -> None:
+        """Удаляет ответы юнитов, чьи поддеревья изменились. Вызывается после комита изменений"""
+        self.generation += 1
+        for key in keys:
+            if self.items.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        """Сброс всех ответов, когда неизвестно, какие поддеревья изменились"""
+        self.generation += 1
+        self.invalidations += len(self.items)
+        self.items.clear()
+
+    def apply_message(self, message: str) -> None:
+        """Применение инвалидации из make_invalidation_message, пришедшей от воркера (в т.ч. от этого же)"""
+        if message == "*":
+            self.clear()
+        elif message:
+            self.invalidate(message.split(","))
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "size": len(self.items),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
+
+
+settings = CacheSettings()
+nodes_cache = ResponseCache(settings.max_size)  # Кэш ответов /nodes/{id}
@@ -1,20 +1,21 @@
-import json
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import Any
 
-from fastapi import APIRouter, Depends
-from fastapi.responses import JSONResponse
-from sqlalchemy import asc
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import JSONResponse, ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from api.exceptions import ElementIdException, IdExceptionsTypes
-from api.schema import ShopUnitStatisticResponse, ShopUnitStatisticUnit, ShopUnitType, Error
-from api.service_funcs import get_element_with_validation
+from api.schema import ShopUnitStatisticResponse, ShopUnitStatisticBucketsResponse, StatisticBucket, Error
+from api.service_funcs import get_element_with_validation, make_statistic_unit, get_sales, get_unit_history, \
+    get_unit_history_buckets, encode_cursor, decode_cursor
 from db.main import get_db
-from db.schema import ShopUnitsDB, ShopUnitUpdatesDB
+from db.schema import ShopUnitsDB
 
 router = APIRouter()  # Создание роутера, который хранит все пути в данном файле к ручкам и передаёт в main app
 
+MAX_PAGE_LIMIT = 10000  # Максимальный размер страницы в постраничной выдаче
+
 
 # Класс в котором лежат все модели и описания респонзов
 class MyResponses:
@@ -26,43 +27,51 @@ class MyResponses:
 
     node_stats: dict[int, dict[str, Any]] = \
         {
-            200: {"model": ShopUnitStatisticResponse, "description": "Список товаров, цена которых была обновлена."},
+            200: {"model": ShopUnitStatisticResponse | ShopUnitStatisticBucketsResponse,
+                  "description": "История обновлений юнита или, с bucket, её агрегаты по интервалам."},
             400: {"model": Error, "description": "Некорректный формат запроса или некорректные даты интервала."},
             404: {"model": Error, "description": "Категория/товар не найден."}
         }
 
 
 @router.get("/sales", responses=MyResponses.sales, tags=["additional tasks"])
-async def info_about_last_updates(date: str, db: Session = Depends(get_db)) -> JSONResponse:
-    """Получение списка **товаров**, цена которых была обновлена за последние 24 часа"""
+async def info_about_last_updates(date: str, limit: int | None = Query(None, ge=1, le=MAX_PAGE_LIMIT),
+                                  cursor: str | None = None, db: AsyncSession = Depends(get_db)) -> JSONResponse:
+    """
+    Получение списка **товаров**, цена которых была обновлена за последние 24 часа.
+    С limit отдаётся страница из limit товаров по порядку обновления и nextCursor для запроса следующей
+    """
     try:
-        new_date: datetime = datetime.strptime(date, "%Y-%m-%dT%H:%M:%S.000Z")
+        new_date: datetime = datetime.strptime(date, "%Y-%m-%dT%H:%M:%S.000Z").replace(tzinfo=timezone.utc)
+        after: tuple[datetime, str] | None = decode_cursor(cursor, datetime, str) if cursor is not None else None
     except ValueError:
         return JSONResponse(status_code=400, content={"code": 400, "message": "Validation Failed"})
 
     day_ago_time: datetime = new_date - timedelta(hours=24)
-    items: list[ShopUnitsDB] = db.query(ShopUnitsDB).filter(ShopUnitsDB.last_update >= day_ago_time).\
-        filter(ShopUnitsDB.last_update <= new_date).filter(ShopUnitsDB.type == ShopUnitType.offer).all()
-    res_list: list[ShopUnitStatisticUnit] = []
-    for item in items:
-        new_item: ShopUnitStatisticUnit = ShopUnitStatisticUnit(
-            id=item.id,
-            name=item.name,
-            parentId=item.parent_category,
-            type=item.type,
-            price=item.price,
-            date=item.last_update.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-        )
-        res_list.append(new_item)
-    response = ShopUnitStatisticResponse(items=res_list)
-    return JSONResponse(status_code=200, content=json.loads(response.json()))
+    items = await get_sales(day_ago_time, new_date, limit + 1 if limit is not None else None, after, db)
+    res_list: list[dict[str, Any]] = [
+        make_statistic_unit(item.id, item.name, item.parent_category, item.type, item.price, item.last_update)
+        for item in items[:limit]
+    ]
+    content: dict[str, Any] = {"items": res_list}
+    if limit is not None:
+        content["nextCursor"] = encode_cursor(items[limit - 1].last_update, items[limit - 1].id) \
+            if len(items) > limit else None
+    return ORJSONResponse(status_code=200, content=content)
 
 
 @router.get("/node/{id}/statistic", responses=MyResponses.node_stats, tags=["additional tasks"])
-async def units_updated_in_range(id: str, dateStart: str, dateEnd: str, db: Session = Depends(get_db)) -> JSONResponse:
-    """Получение статистики (истории обновлений) по товару/категории за заданный полуинтервал [from, to)."""
+async def units_updated_in_range(id: str, dateStart: str, dateEnd: str,
+                                 limit: int | None = Query(None, ge=1, le=MAX_PAGE_LIMIT), after: str | None = None,
+                                 bucket: StatisticBucket | None = None,
+                                 db: AsyncSession = Depends(get_db)) -> JSONResponse:
+    """
+    Получение статистики (истории обновлений) по товару/категории за заданный полуинтервал [from, to).
+    С limit отдаётся страница из limit записей по порядку обновления и nextCursor, который передаётся в after.
+    С bucket (hour, day, week) вместо записей отдаются агрегаты цены по интервалам, без постраничной выдачи
+    """
     try:
-        get_element_with_validation(element_id=id, db=db)
+        element: ShopUnitsDB = await get_element_with_validation(element_id=id, db=db)
     except ElementIdException as e:
         status_code = 400 if e.type == IdExceptionsTypes.uuid else 404
         return JSONResponse(status_code=status_code,
@@ -74,22 +83,31 @@ async def units_updated_in_range(id: str, dateStart: str, dateEnd: str, db: Sess
 
     try:
         new_date_end: datetime = datetime.strptime(dateEnd, "%Y-%m-%dT%H:%M:%S.000Z")
+        after_key: tuple[datetime, int] | None = None
+        if after is not None:
+            after_date, after_id = decode_cursor(after, datetime, int)
+            # Даты логов хранятся в UTC без часового пояса
+            after_key = (after_date.astimezone(timezone.utc).replace(tzinfo=None), after_id)
     except ValueError:
         return JSONResponse(status_code=400, content={"code": 400, "message": "Validation Failed"})
-    items: list[ShopUnitUpdatesDB] = db.query(ShopUnitUpdatesDB).filter(ShopUnitUpdatesDB.unit_id == id).\
-        filter(ShopUnitUpdatesDB.update_date >= new_date_start).\
-        filter(ShopUnitUpdatesDB.update_date < new_date_end).order_by(asc(ShopUnitUpdatesDB.id)).all()
-    res_list: list[ShopUnitStatisticUnit] = []
-    for update in items:
-        unit: ShopUnitsDB = db.query(ShopUnitsDB).filter(ShopUnitsDB.id == update.unit_id).first()
-        res_unit: ShopUnitStatisticUnit = ShopUnitStatisticUnit(
-            id=unit.id,
-            name=update.name,
-            parentId=update.parent_category,
-            type=unit.type,
-            price=update.price,
-            date=update.update_date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-        )
-        res_list.append(res_unit)
-    response = ShopUnitStatisticResponse(items=res_list)
-    return JSONResponse(status_code=200, content=json.loads(response.json()))
+
+    if bucket is not None:
+        if limit is not None or after is not None:
+            return JSONResponse(status_code=400, content={"code": 400, "message": "Validation Failed"})
+        buckets: list[dict[str, Any]] = await get_unit_history_buckets(element.id, new_date_start, new_date_end,
+                                                                       bucket, db)
+        return ORJSONResponse(status_code=200, content={"items": buckets})
+
+    items = await get_unit_history(element.id, new_date_start, new_date_end,
+                                   limit + 1 if limit is not None else None, after_key, db)
+    # Тип у всех записей один - тип самого юнита, он уже загружен при валидации id
+    res_list: list[dict[str, Any]] = [
+        make_statistic_unit(element.id, update.name, update.parent_category, element.type, update.price,
+                            update.update_date)
+        for update in items[:limit]
+    ]
+    content: dict[str, Any] = {"items": res_list}
+    if limit is not None:
+        content["nextCursor"] = encode_cursor(items[limit - 1].update_date, items[limit - 1].id) \
+            if len(items) > limit else None
+    return ORJSONResponse(status_code=200, content=content)
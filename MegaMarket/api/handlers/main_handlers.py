@@ -1,20 +1,35 @@
-import json
-from typing import Any
+import time
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator
 
-from fastapi import APIRouter, Depends, status
-from fastapi.responses import JSONResponse
-from sqlalchemy import desc
-from sqlalchemy.orm import Session
+import orjson
+from fastapi import APIRouter, Depends, Query, Request, status
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from api.cache import nodes_cache, make_invalidation_message
+from api.jobs import notify_import_worker
+from api.metrics import observe_import
 from api.exceptions import InvalidImport, ElementIdException, IdExceptionsTypes
-from api.schema import ShopUnitImportRequest, ShopUnitImport, ShopUnitType, ShopUnit, Error
-from api.service_funcs import from_pyschema_to_db_schema, add_and_refresh_db, delete_all_children, get_all_children, \
-    get_category_price, get_element_with_validation, update_parents, make_update_log
+from api.schema import ShopUnitImportRequest, ShopUnitImport, ShopUnit, ImportJob, Error
+from api.validation import validate_request, validate_hierarchy
+from api.service_funcs import get_subtree_ids, delete_units, get_subtree, create_import, \
+    stream_subtree, get_subtree_levels, \
+    get_element_with_validation, update_parents, make_update_log, \
+    apply_aggregates_delta, get_unit_contribution, lock_catalog, get_units_with_ancestors, \
+    update_units, save_logs, iter_ndjson, import_batch, create_stream_ids_table, find_repeated_id, \
+    create_import_job, get_import_job, make_import_job, publish_invalidation, decode_cursor
 from db.main import get_db
-from db.schema import ShopUnitsDB, ShopUnitUpdatesDB
+from db.schema import ShopUnitsDB, ImportsDB, ImportJobsDB
 
 router = APIRouter()  # Создание роутера, который хранит все пути в данном файле к ручкам и передаёт в main app
 
+MAX_CHILDREN_LIMIT = 1000  # Максимальный размер страницы детей в /nodes
+IMPORT_BATCH_SIZE = 5000  # Сколько юнитов потокового импорта валидировать и записывать за раз
+# Сколько юнитов потокового импорта может ждать ещё не пришедших родителей. Отложенные юниты проверяются заново
+# с каждой пачкой, поэтому без предела поток "дети раньше родителей" стоил бы O(n^2) и держал бы всё в памяти
+MAX_STREAM_PENDING = IMPORT_BATCH_SIZE
+
 
 # Класс в котором лежат все модели и описания респонзов
 class MyResponses:
@@ -24,6 +39,20 @@ class MyResponses:
             400: {"model": Error, "description": "Невалидная схема документа или входные данные не верны."}
         }
 
+    import_async: dict[int, dict[str, Any]] = \
+        {
+            200: {"description": "Вставка или обновление прошли успешно."},
+            202: {"model": ImportJob, "description": "Импорт поставлен в очередь (background=true)."},
+            400: {"model": Error, "description": "Невалидная схема документа или входные данные не верны."}
+        }
+
+    import_job: dict[int, dict[str, Any]] = \
+        {
+            200: {"model": ImportJob, "description": "Состояние задачи импорта."},
+            400: {"model": Error, "description": "Невалидная схема документа или входные данные не верны."},
+            404: {"model": Error, "description": "Задача не найдена."}
+        }
+
     delete: dict[int, dict[str, Any]] = \
         {
             200: {"description": "Удаление прошло успешно."},
@@ -39,92 +68,227 @@ class MyResponses:
         }
 
 
-@router.post("/imports", responses=MyResponses.imports, tags=["main tasks"])
-async def make_import(items: ShopUnitImportRequest,
-                      db: Session = Depends(get_db)) -> str | JSONResponse:
+@router.post("/imports", responses=MyResponses.import_async, tags=["main tasks"])
+async def make_import(items: ShopUnitImportRequest, background: bool = False,
+                      db: AsyncSession = Depends(get_db)) -> str | JSONResponse:
     """
     Handler для импорта и обновления элементов таблицы ShopUnitDB,
     которые являются категориями и товарами данного магазина.
-    Все юниты проходят валидации и в случае успеха, обновляют таблицу,
-    в таблицу ShopUnitUpdatesDB кладётся лог об обновлении каждого элемента для сохранения истории.
+    Все юниты и их предки загружаются из БД одним заходом, валидируются в памяти,
+    записываются одним INSERT ... ON CONFLICT DO UPDATE и комитятся один раз, так что
+    невалидный импорт не оставляет в БД частичных изменений.
+    В таблицу ShopUnitUpdatesDB кладётся лог об обновлении каждого элемента для сохранения истории.
+    С background=true после проверки схемы, повторов id и цен импорт ставится в очередь и сразу отдаётся задача,
+    воркер применяет задачи по порядку, а их состояние отдаёт GET /imports/{job_id}
     """
-    # Словарь со всеми id данного запроса, для валидации повторений и со значениями в виде типа юнита,
-    # для поиска родительской категории во время валидации.
-    request_ids: dict[str, ShopUnitType] = {}
-    res_list: list[ShopUnitsDB] = []  # Список в котором будут лежать отваледированные товары
-    for item in items.items:  # Валидация повторений id и заполнения словарь request_ids
-        item: ShopUnitImport = item
-        if item.id in request_ids.keys():
+    started: float = time.perf_counter()
+    if background:
+        try:  # Родителей, смену типа и циклы проверит воркер по состоянию БД на момент выполнения задачи
+            validate_request(items.items)
+        except InvalidImport as e:
             return JSONResponse(status_code=400,
-                                content={"code": 400, "message": f"Данный id={item.id} встретился больше одного раза."})
-        item_from_fb: ShopUnitsDB = db.query(ShopUnitsDB).filter(ShopUnitsDB.id == item.id).first()
-        request_ids[item.id] = item.type if item_from_fb is None else item_from_fb.type
+                                content={"code": 400, "message": e.message})
+        job: ImportJobsDB = await create_import_job(orjson.loads(items.json()), db)
+        await db.commit()
+        notify_import_worker()
+        return ORJSONResponse(status_code=202, content=make_import_job(job))
+
+    update_date: datetime = datetime.strptime(items.updateDate, "%Y-%m-%dT%H:%M:%S.000Z").replace(tzinfo=timezone.utc)
+    await lock_catalog(db)
+    import_record: ImportsDB = await create_import(update_date, len(items.items), db)  # Создаём id данного реквеста
+    try:  # Весь запрос проверяется разом по загруженным юнитам, до каких-либо изменений, запись импорта откатится
+        changed, _ = await import_batch(items.items, update_date, import_record.id, db)
+    except InvalidImport as e:
+        return JSONResponse(status_code=400,
+                            content={"code": 400, "message": e.message})
+    import_record.processing_time = time.perf_counter() - started
+    await publish_invalidation(changed, db)
+    await db.commit()
+    nodes_cache.invalidate(changed)
+    observe_import("sync", len(items.items), len(changed) - len(items.items), import_record.processing_time)
+    return status.HTTP_200_OK
 
-    for item in items.items:  # Цикол с заключительными валидациями, после чего добавляются в res_list
-        item: ShopUnitImport = item
+
+@router.get("/imports/{job_id}", responses=MyResponses.import_job, tags=["main tasks"])
+async def get_import_job_status(job_id: int, db: AsyncSession = Depends(get_db)) -> JSONResponse:
+    """Состояние задачи асинхронного импорта: в очереди, выполняется, выполнена или отклонена и почему"""
+    job: ImportJobsDB | None = await get_import_job(job_id, db)
+    if job is None:
+        return JSONResponse(status_code=404, content={"code": 404, "message": "Import job with given ID is not found"})
+    return ORJSONResponse(status_code=200, content=make_import_job(job))
+
+
+@router.post("/imports/stream", responses=MyResponses.imports, tags=["main tasks"],
+             openapi_extra={"requestBody": {"required": True, "content": {"application/x-ndjson": {
+                 "schema": {"type": "string", "description": "По одному ShopUnitImport в формате JSON на строку"}
+             }}}})
+async def make_stream_import(request: Request, updateDate: str,
+                             db: AsyncSession = Depends(get_db)) -> str | JSONResponse:
+    """
+    Handler для импорта больших выгрузок каталога в формате NDJSON: по одному ShopUnitImport на строку,
+    дата обновления передаётся в updateDate. Тело читается по мере получения и валидируется и записывается
+    пачками по IMPORT_BATCH_SIZE юнитов по тем же правилам, что и /imports, весь импорт - одна транзакция
+    с одним import_request_id. Родители должны идти раньше детей: юнит может ссылаться на родителя
+    из следующих строк, но таких юнитов одновременно может быть не больше MAX_STREAM_PENDING, иначе импорт
+    отклоняется. В памяти держатся только текущая пачка и отложенные юниты: повторы id ищутся во временной
+    таблице id потока, логи категорий пишутся с каждой пачкой, а изменившиеся поддеревья для инвалидации кэша
+    копятся, только пока помещаются в NOTIFY, дальше по комиту сбрасываются кэши целиком
+    """
+    started: float = time.perf_counter()
+    try:
+        update_date: datetime = datetime.strptime(updateDate, "%Y-%m-%dT%H:%M:%S.000Z").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return JSONResponse(status_code=400, content={"code": 400, "message": "Validation Failed"})
+
+    await lock_catalog(db)
+    import_record: ImportsDB = await create_import(update_date, 0, db)
+    await create_stream_ids_table(db)
+    items_count: int = 0
+    ancestors_count: int = 0  # Обновлённые предки юнитов потока, общий предок нескольких пачек считается в каждой
+    changed: set[str] | None = set()  # Юниты, чьи поддеревья изменились, None - их слишком много для NOTIFY
+    pending: list[ShopUnitImport] = []
+
+    async def apply_batch(batch: list[ShopUnitImport]) -> None:
+        nonlocal items_count, ancestors_count, changed, pending
+        repeated: str | None = await find_repeated_id([item.id for item in batch], db)
+        if repeated is not None:
+            raise InvalidImport(message=f"Данный id={repeated} встретился больше одного раза.")
+        items_count += len(batch)
+        batch = pending + batch
+        batch_changed, pending = await import_batch(batch, update_date, import_record.id, db, defer_unresolved=True)
+        ancestors_count += len(batch_changed) - (len(batch) - len(pending))
+        if changed is not None:
+            changed |= batch_changed
+            if make_invalidation_message(changed) == "*":
+                changed = None
+
+    batch: list[ShopUnitImport] = []
+    try:
+        async for obj in iter_ndjson(request.stream()):
+            batch.append(ShopUnitImport.parse_obj(obj))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                await apply_batch(batch)
+                batch = []
+                if len(pending) > MAX_STREAM_PENDING:
+                    return JSONResponse(status_code=400, content={"code": 400, "message": (
+                        "Слишком много юнитов ждут ещё не пришедших родителей, "
+                        f"родители должны идти раньше детей: id={pending[0].id}")})
+        await apply_batch(batch)
+    except InvalidImport as e:
+        return JSONResponse(status_code=400,
+                            content={"code": 400, "message": e.message})
+    except ValueError:  # Невалидный JSON в строке или юнит не по схеме ShopUnitImport
+        return JSONResponse(status_code=400, content={"code": 400, "message": "Validation Failed"})
+    if pending:  # Отложенные юниты ссылаются друг на друга по кругу или родитель так и не пришёл
         try:
-            item: ShopUnitsDB = from_pyschema_to_db_schema(item, items.updateDate, request_ids, db)
-            res_list.append(item)
+            validate_hierarchy({item.id: item for item in pending}, {})
         except InvalidImport as e:
             return JSONResponse(status_code=400,
                                 content={"code": 400, "message": e.message})
+        return JSONResponse(status_code=400, content={
+            "code": 400, "message": f"Такого родителя не существует или он не является категорией: id={pending[0].id}"})
 
-    # Создаём id данного реквеста
-    import_id: ShopUnitUpdatesDB = db.query(ShopUnitUpdatesDB).\
-        order_by(desc(ShopUnitUpdatesDB.import_request_id)).first()
-    if import_id is not None:
-        import_id: int = import_id.import_request_id + 1
+    import_record.items_count = items_count
+    import_record.processing_time = time.perf_counter() - started
+    await publish_invalidation(changed, db)
+    await db.commit()
+    if changed is None:
+        nodes_cache.clear()
     else:
-        import_id: int = 0
-
-    for unit in res_list:  # добавления/обновление в базу всех элементов из запроса
-        add_and_refresh_db(unit, db)
-
-    for unit in res_list:  # Создаём update логи для элемента и родителей
-        make_update_log(unit, import_id, db)
-        if unit.parent_category is not None and (unit.type != ShopUnitType.category):
-            update_parents(unit.parent_category, items.updateDate, import_id, db)
+        nodes_cache.invalidate(changed)
+    observe_import("stream", items_count, ancestors_count, import_record.processing_time)
     return status.HTTP_200_OK
 
 
 @router.delete("/delete/{id}", responses=MyResponses.delete, tags=["main tasks"])
-async def delete_element(id: str, db: Session = Depends(get_db)) -> str | JSONResponse:
-    """Handler для удаления юнита и всех его дочерних элементов"""
+async def delete_element(id: str, date: str | None = None, db: AsyncSession = Depends(get_db)) -> str | JSONResponse:
+    """
+    Handler для удаления юнита и всех его дочерних элементов.
+    Поддерево и его логи удаляются двумя массовыми запросами в одной транзакции,
+    из агрегатов оставшихся предков вычитается вклад удалённых товаров.
+    Если передан date, предкам проставляется эта дата обновления и пишутся логи с их новыми ценами
+    """
+    update_date: datetime | None = None
+    if date is not None:
+        try:
+            update_date = datetime.strptime(date, "%Y-%m-%dT%H:%M:%S.000Z").replace(tzinfo=timezone.utc)
+        except ValueError:
+            return JSONResponse(status_code=400, content={"code": 400, "message": "Validation Failed"})
+
+    await lock_catalog(db)
     try:
-        element: ShopUnitsDB = get_element_with_validation(element_id=id, db=db)
+        element: ShopUnitsDB = await get_element_with_validation(element_id=id, db=db)
     except ElementIdException as e:
         status_code = 400 if e.type == IdExceptionsTypes.uuid else 404
         return JSONResponse(status_code=status_code,
                             content={"code": status_code, "message": e.message})
 
-    db.query(ShopUnitUpdatesDB).filter(ShopUnitUpdatesDB.unit_id == id).delete()
-    db.commit()
+    # Вычитаем вклад удаляемого поддерева из агрегатов оставшихся предков
+    ancestors: dict[str, ShopUnitsDB] = await get_units_with_ancestors({element.parent_category} - {None}, db)
+    delta_sum, delta_count = get_unit_contribution(element)
+    apply_aggregates_delta(element.parent_category, -delta_sum, -delta_count, ancestors)
+    logs: list[dict[str, Any]] = []
+    if update_date is not None:
+        import_id: int = (await create_import(update_date, 0, db)).id  # Удаление пишется в журнал как импорт без юнитов
+        logs = [make_update_log(parent, import_id)
+                for parent in update_parents(element.parent_category, update_date, ancestors)]
+    await update_units(list(ancestors.values()), db)
 
-    delete_all_children(elem_id=id, db=db)
-    db.delete(element)
-    db.commit()
+    subtree_ids: list[str] = await get_subtree_ids(element.path, db)
+    await delete_units(subtree_ids, db)
+    await save_logs(logs, db)
+    await publish_invalidation(subtree_ids + list(ancestors.keys()), db)
+    await db.commit()
+    nodes_cache.invalidate(subtree_ids + list(ancestors.keys()))
 
     return status.HTTP_200_OK
 
 
 @router.get("/nodes/{id}", responses=MyResponses.get_node, tags=["main tasks"])
-async def get_info_about_element(id: str, db: Session = Depends(get_db)) -> JSONResponse:
-    """Handler, который возвращает информацию о юните из магазина."""
+async def get_info_about_element(id: str, stream: bool = False,
+                                 depth: int | None = Query(None, ge=0),
+                                 limit: int | None = Query(None, ge=1, le=MAX_CHILDREN_LIMIT),
+                                 cursor: str | None = None,
+                                 db: AsyncSession = Depends(get_db)) -> Response:
+    """
+    Handler, который возвращает информацию о юните из магазина вместе со всеми его потомками.
+    Готовые ответы хранятся в nodes_cache, импорты и удаления сбрасывают ответы изменившихся юнитов.
+    С stream=true дерево не собирается в памяти, а отдаётся по частям по мере чтения из БД, такой ответ не кэшируется.
+    С depth отдаётся не больше depth уровней потомков, с limit/cursor - страница детей элемента после cursor,
+    такие ответы собираются по уровням и не кэшируются, stream для них игнорируется
+    """
+    if depth is not None or limit is not None or cursor is not None:
+        try:
+            after: str | None = decode_cursor(cursor, str)[0] if cursor is not None else None
+        except ValueError:
+            return JSONResponse(status_code=400, content={"code": 400, "message": "Validation Failed"})
+        try:
+            element: ShopUnitsDB = await get_element_with_validation(element_id=id, db=db)
+        except ElementIdException as e:
+            status_code = 400 if e.type == IdExceptionsTypes.uuid else 404
+            return JSONResponse(status_code=status_code,
+                                content={"code": status_code, "message": e.message})
+        return ORJSONResponse(status_code=200, content=await get_subtree_levels(element, depth, limit, after, db))
+
+    cached: bytes | None = nodes_cache.get(id)
+    if cached is not None:
+        return Response(status_code=200, content=cached, media_type="application/json")
+    generation: int = nodes_cache.generation
     try:
-        element: ShopUnitsDB = get_element_with_validation(element_id=id, db=db)
+        element: ShopUnitsDB = await get_element_with_validation(element_id=id, db=db)
+        if stream:
+            body: AsyncIterator[bytes] | None = await stream_subtree(element.path, db)
+            if body is None:  # Элемент мог быть удалён между двумя запросами
+                raise ElementIdException(IdExceptionsTypes.not_found)
+            return StreamingResponse(body, status_code=200, media_type="application/json")
+        res_node: dict[str, Any] | None = await get_subtree(element.path, db)
+        if res_node is None:
+            raise ElementIdException(IdExceptionsTypes.not_found)
     except ElementIdException as e:
         status_code = 400 if e.type == IdExceptionsTypes.uuid else 404
         return JSONResponse(status_code=status_code,
                             content={"code": status_code, "message": e.message})
 
-    children_list: list[ShopUnit] = get_all_children(id, db)
-    res_node: ShopUnit = ShopUnit(
-            id=element.id,
-            name=element.name,
-            date=element.last_update.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
-            parentId=element.parent_category,
-            type=element.type,
-            price=element.price if element.type == ShopUnitType.offer else get_category_price(element.id, db, []),
-            children=None if element.type == ShopUnitType.offer else children_list
-        )
-    return JSONResponse(status_code=200, content=json.loads(res_node.json()))
+    response = ORJSONResponse(status_code=200, content=res_node)
+    nodes_cache.put(id, response.body, generation)
+    return response
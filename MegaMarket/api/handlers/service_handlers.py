@@ -0,0 +1,54 @@
+from typing import Any
+
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse, Response
+
+from api.cache import nodes_cache
+from api.metrics import render_metrics, CONTENT_TYPE
+from api.schema import PoolStats, CacheStats
+from db.main import get_pool_stats
+
+router = APIRouter()  # Создание роутера, который хранит все пути в данном файле к ручкам и передаёт в main app
+
+
+# Класс в котором лежат все модели и описания респонзов
+class MyResponses:
+    pool: dict[int, dict[str, Any]] = \
+        {
+            200: {"model": PoolStats, "description": "Состояние пула соединений к БД в данном воркере."}
+        }
+
+    cache: dict[int, dict[str, Any]] = \
+        {
+            200: {"model": CacheStats, "description": "Счётчики кэша ответов /nodes в данном воркере."}
+        }
+
+    metrics: dict[int, dict[str, Any]] = \
+        {
+            200: {"content": {CONTENT_TYPE: {}}, "description": "Метрики в текстовом формате Prometheus."}
+        }
+
+
+@router.get("/service/pool", responses=MyResponses.pool, tags=["service"])
+async def pool_stats() -> JSONResponse:
+    """
+    Состояние пула соединений к БД воркера, обработавшего запрос: занятые и свободные соединения,
+    соединения сверх pool_size и время ожидания свободного соединения
+    """
+    return JSONResponse(status_code=200, content=PoolStats(**get_pool_stats()).dict())
+
+
+@router.get("/service/cache", responses=MyResponses.cache, tags=["service"])
+async def cache_stats() -> JSONResponse:
+    """Счётчики кэша ответов /nodes/{id} воркера, обработавшего запрос: попадания, промахи и вытеснения"""
+    return JSONResponse(status_code=200, content=CacheStats(**nodes_cache.stats()).dict())
+
+
+@router.get("/metrics", responses=MyResponses.metrics, tags=["service"])
+async def metrics() -> Response:
+    """
+    Метрики для Prometheus: число, статусы и гистограммы времени запросов по ручкам, число и время SQL запросов
+    на запрос, а также размер импортов, число затронутых ими предков и время их применения
+    """
+    # media_type Starlette дополнил бы вторым charset, у CONTENT_TYPE он уже есть
+    return Response(status_code=200, content=render_metrics(), headers={"Content-Type": CONTENT_TYPE})
@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable
+
+import asyncpg
+from pydantic import BaseSettings, ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.cache import nodes_cache, settings as cache_settings, INVALIDATION_CHANNEL
+from api.exceptions import InvalidImport
+from api.metrics import observe_import
+from api.schema import ShopUnitImportRequest, ImportJobStatus, StatisticBucket
+from api.service_funcs import lock_catalog, create_import, import_batch, get_next_import_job, set_import_job_status, \
+    publish_invalidation, start_import_job, count_import_job_failure, lock_maintenance, get_missing_log_partitions, \
+    create_log_partition, get_compaction_months, compact_logs, get_expired_log_partitions, drop_log_partition
+from db.main import SessionLocal, database_url
+from db.schema import ImportJobsDB, ImportsDB
+
+logger = logging.getLogger(__name__)
+
+
+class ImportJobsSettings(BaseSettings):
+    """Настройки воркера асинхронных импортов, читаются из переменных окружения с префиксом IMPORT_JOBS_"""
+    poll_interval: float = 1.0  # Как часто в секундах проверять очередь на задачи, поставленные другими процессами
+    shutdown_timeout: float = 30  # Сколько секунд при остановке ждать текущую задачу, потом она прерывается
+    max_attempts: int = 5  # После стольких попыток, упавших не из-за данных (БД недоступна и т.п.), задача - failed
+
+    class Config:
+        env_prefix = "IMPORT_JOBS_"
+
+
+class LogsSettings(BaseSettings):
+    """Настройки хранения update логов, читаются из переменных окружения с префиксом LOGS_"""
+    raw_retention_days: int | None = None  # Сколько дней хранить логи без свёртки, None - хранить все
+    rollup_bucket: StatisticBucket = StatisticBucket.day  # Интервал, по которому сворачиваются старые логи
+    partitions_ahead: int = 2  # На сколько месяцев вперёд заранее создавать секции логов
+    maintenance_interval: float = 3600  # Как часто в секундах создавать секции и сворачивать старые логи
+    lock_timeout: float = 1.0  # Сколько секунд шаг обслуживания ждёт блокировки таблицы логов, потом откладывается
+
+    class Config:
+        env_prefix = "LOGS_"
+
+
+settings = ImportJobsSettings()
+logs_settings = LogsSettings()
+jobs_enqueued = asyncio.Event()  # Будит воркер, когда задачу поставил этот же процесс
+worker_stopping = asyncio.Event()  # Просит воркер завершиться после текущей задачи
+
+
+def notify_import_worker() -> None:
+    jobs_enqueued.set()
+
+
+async def stop_import_worker(worker: asyncio.Task) -> None:
+    """
+    Остановка воркера после текущей задачи. Задача, не успевшая за shutdown_timeout,
+    прерывается, её транзакция откатывается, и она будет выполнена заново
+    """
+    worker_stopping.set()
+    jobs_enqueued.set()
+    try:
+        await asyncio.wait_for(worker, timeout=settings.shutdown_timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Import job was interrupted by shutdown and will be retried")
+
+
+async def apply_import_job(job: ImportJobsDB, db: AsyncSession) -> tuple[set[str], ImportsDB]:
+    """
+    Применение задачи по тем же правилам, что и /imports, без комита.
+    Возвращает id юнитов, чьи поддеревья изменились (юниты задачи и их предки), и запись импорта в журнале
+    """
+    started: float = time.perf_counter()
+    request: ShopUnitImportRequest = ShopUnitImportRequest.parse_obj(job.payload)
+    update_date: datetime = datetime.strptime(request.updateDate, "%Y-%m-%dT%H:%M:%S.000Z").replace(tzinfo=timezone.utc)
+    import_record: ImportsDB = await create_import(update_date, len(request.items), db)
+    changed, _ = await import_batch(request.items, update_date, import_record.id, db)
+    import_record.processing_time = time.perf_counter() - started
+    job.import_id = import_record.id
+    return changed, import_record
+
+
+async def process_next_job() -> bool:
+    """
+    Выполнение самой старой задачи очереди, возвращает False, если очередь пуста.
+    Задача выбирается и применяется под блокировкой каталога, поэтому воркеры всех процессов
+    применяют задачи по одной и по порядку id. Статус running комитится до блокировки, чтоб его было видно
+    в GET /imports/{job_id}, пока импорт выполняется, и воркеру хватало одного соединения.
+    Невалидная задача получает статус failed, а при других ошибках транзакция откатывается, ошибка пробрасывается,
+    и задача остаётся в очереди до следующей попытки, пока таких попыток не наберётся max_attempts
+    """
+    async with SessionLocal() as db:
+        job: ImportJobsDB | None = await get_next_import_job(db)  # Без блокировки, чтоб пустой опрос не ждал импорты
+        if job is None:
+            return False
+        job_id: int = job.id
+        await start_import_job(job_id, db)
+        await db.commit()
+        await lock_catalog(db)
+        job = await get_next_import_job(db)
+        if job is None or job.id != job_id:  # Задачу успел выполнить воркер другого процесса, берём следующую
+            return True
+
+        try:
+            changed, import_record = await apply_import_job(job, db)
+        except Exception as e:
+            await db.rollback()
+            if isinstance(e, (InvalidImport, ValidationError)):
+                error: str = e.message if isinstance(e, InvalidImport) else "Validation Failed"
+            else:
+                attempts: int = await count_import_job_failure(job_id, db)
+                if attempts < settings.max_attempts:
+                    await db.commit()
+                    raise
+                logger.exception("Import job %s failed after %s attempts", job_id, attempts)
+                error = "Internal Server Error"
+            await set_import_job_status(job_id, ImportJobStatus.failed, db, error=error,
+                                        finished_at=datetime.now(timezone.utc))
+            await db.commit()
+            return True
+        job.status = ImportJobStatus.done
+        job.finished_at = datetime.now(timezone.utc)
+        await publish_invalidation(changed, db)
+        await db.commit()
+    nodes_cache.invalidate(changed)
+    observe_import("job", import_record.items_count, len(changed) - import_record.items_count,
+                   import_record.processing_time)
+    return True
+
+
+async def run_import_worker() -> None:
+    """Фоновый цикл воркера: выполняет задачи, пока очередь не опустеет, затем ждёт новых, до stop_import_worker"""
+    while not worker_stopping.is_set():
+        try:
+            while not worker_stopping.is_set() and await process_next_job():
+                pass
+        except Exception:  # БД недоступна и т.п., задача останется в очереди до следующей попытки
+            logger.exception("Import worker iteration failed")
+        try:
+            await asyncio.wait_for(jobs_enqueued.wait(), timeout=settings.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        jobs_enqueued.clear()
+
+
+async def run_maintenance_step(step: Callable[..., Awaitable[None]], *args: Any) -> None:
+    """
+    Шаг обслуживания логов отдельной короткой транзакцией под lock_maintenance. Упавший шаг (например,
+    не дождавшийся блокировки таблицы логов за lock_timeout) повторится следующим проходом
+    """
+    try:
+        async with SessionLocal() as db:
+            await lock_maintenance(logs_settings.lock_timeout, db)
+            await step(*args, db)
+            await db.commit()
+    except Exception:
+        logger.exception("Update logs maintenance step %s%s failed", step.__name__, args)
+
+
+async def maintain_logs() -> None:
+    """
+    Проход обслуживания логов: создание секций на partitions_ahead месяцев вперёд и, если задано хранение,
+    свёртка логов старше raw_retention_days по месяцу за транзакцию и удаление свёрнутых секций.
+    Импорты не ждут обслуживание целиком, а процессы выполняют шаги по очереди, и повторный шаг ничего не делает
+    """
+    now: datetime = datetime.now(timezone.utc).replace(tzinfo=None)
+    async with SessionLocal() as db:
+        months: list[datetime] = await get_missing_log_partitions(now, logs_settings.partitions_ahead, db)
+    for month in months:
+        await run_maintenance_step(create_log_partition, month)
+    if logs_settings.raw_retention_days is None:
+        return
+
+    bucket: StatisticBucket = logs_settings.rollup_bucket
+    async with SessionLocal() as db:
+        before, months = await get_compaction_months(now - timedelta(days=logs_settings.raw_retention_days),
+                                                     bucket, db)
+    for month in months:
+        await run_maintenance_step(compact_logs, month, before, bucket)
+    async with SessionLocal() as db:
+        partitions: list[str] = await get_expired_log_partitions(before, db)
+    for name in partitions:
+        await run_maintenance_step(drop_log_partition, name)
+
+
+async def run_logs_maintenance() -> None:
+    """Фоновый цикл обслуживания логов в каждом процессе, раз в maintenance_interval секунд"""
+    while True:
+        try:
+            await maintain_logs()
+        except Exception:
+            logger.exception("Update logs maintenance failed")
+        await asyncio.sleep(logs_settings.maintenance_interval)
+
+
+async def run_cache_listener() -> None:
+    """
+    Фоновое применение инвалидаций кэша /nodes, которые присылают через NOTIFY все воркеры.
+    Пока соединения нет, уведомления теряются, поэтому после каждого подключения кэш сбрасывается целиком
+    """
+    dsn: str = database_url.set(drivername="postgresql").render_as_string(hide_password=False)
+    while True:
+        connection: asyncpg.Connection | None = None
+        try:
+            connection = await asyncpg.connect(dsn)
+            closed = asyncio.Event()
+            connection.add_termination_listener(lambda conn: closed.set())
+            await connection.add_listener(INVALIDATION_CHANNEL,
+                                          lambda conn, pid, channel, payload: nodes_cache.apply_message(payload))
+            nodes_cache.clear()
+            await closed.wait()
+            logger.warning("Cache invalidation listener connection was lost")
+        except Exception:
+            logger.exception("Cache invalidation listener failed")
+        finally:
+            if connection is not None and not connection.is_closed():
+                await connection.close()
+        await asyncio.sleep(cache_settings.reconnect_interval)
@@ -0,0 +1,53 @@
+import os
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.multiprocess import MultiProcessCollector
+from pydantic import BaseSettings
+
+# Под gunicorn метрики воркеров пишутся в файлы каталога PROMETHEUS_MULTIPROC_DIR (см. gunicorn.conf.py)
+# и собираются вместе при чтении /metrics любым воркером, без него метрики хранятся в памяти процесса
+MULTIPROCESS: bool = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+CONTENT_TYPE: str = CONTENT_TYPE_LATEST
+
+
+class MetricsSettings(BaseSettings):
+    """Настройки метрик, читаются из переменных окружения с префиксом METRICS_"""
+    query_count_header: bool = False  # Отдавать число SQL запросов в заголовке X-Query-Count, нужно бенчмаркам
+
+    class Config:
+        env_prefix = "METRICS_"
+
+
+settings = MetricsSettings()
+
+DB_QUERIES_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, float("inf"))
+IMPORT_SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, float("inf"))
+
+requests_total = Counter("http_requests_total", "Запросы к API", ["method", "route", "status"])
+request_duration = Histogram("http_request_duration_seconds", "Время обработки запроса", ["method", "route"])
+request_db_queries = Histogram("http_request_db_queries", "Число SQL запросов на запрос к API", ["method", "route"],
+                               buckets=DB_QUERIES_BUCKETS)
+request_db_duration = Histogram("http_request_db_duration_seconds", "Суммарное время SQL запросов на запрос к API",
+                                ["method", "route"])
+
+import_items = Histogram("import_items", "Юнитов в импорте", ["kind"], buckets=IMPORT_SIZE_BUCKETS)
+import_ancestors = Histogram("import_ancestors_touched", "Предков, затронутых импортом, без юнитов самого импорта",
+                             ["kind"], buckets=IMPORT_SIZE_BUCKETS)
+import_duration = Histogram("import_duration_seconds", "Время применения импорта", ["kind"],
+                            buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, float("inf")))
+
+
+def observe_import(kind: str, items: int, ancestors: int, seconds: float) -> None:
+    """Метрики применённого импорта, kind - sync (/imports), stream (/imports/stream) или job (очередь)"""
+    import_items.labels(kind).observe(items)
+    import_ancestors.labels(kind).observe(ancestors)
+    import_duration.labels(kind).observe(seconds)
+
+
+def render_metrics() -> bytes:
+    """Метрики в текстовом формате Prometheus, под gunicorn - сумма по всем воркерам"""
+    if not MULTIPROCESS:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry)
+    return generate_latest(registry)
@@ -1,15 +1,41 @@
-from fastapi import Request, Response
+import time
 
-from db.main import SessionLocal
-from main import app
+from fastapi import Request
+from starlette.routing import Match
 
+from api.metrics import settings, requests_total, request_duration, request_db_queries, request_db_duration
+from db.main import QueryCounter, query_counter
 
-@app.middleware("http")
-async def db_session_middleware(request: Request, call_next):
-    response = Response("Internal server error", status_code=500)
+
+def get_route_path(request: Request) -> str:
+    """Шаблон пути ручки (/nodes/{id}), а не сам путь, чтоб число серий метрик не росло с числом юнитов"""
+    for route in request.app.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+async def metrics_middleware(request: Request, call_next):
+    """
+    Метрики запроса: число, статус и время по ручкам, число и время SQL запросов.
+    С METRICS_QUERY_COUNT_HEADER число SQL запросов также отдаётся в заголовке X-Query-Count, по нему
+    бенчмарки считают запросы на ручку, по умолчанию клиентам он не отдаётся.
+    У потоковых ответов учитываются только запросы и время до отправки заголовков
+    """
+    counter = QueryCounter()
+    query_counter.set(counter)
+    started: float = time.perf_counter()
+    status: int = 500
     try:
-        request.state.db = SessionLocal()
         response = await call_next(request)
+        status = response.status_code
     finally:
-        request.state.db.close()
+        route: str = get_route_path(request)
+        requests_total.labels(request.method, route, str(status)).inc()
+        request_duration.labels(request.method, route).observe(time.perf_counter() - started)
+        request_db_queries.labels(request.method, route).observe(counter.count)
+        request_db_duration.labels(request.method, route).observe(counter.time)
+    if settings.query_count_header:
+        response.headers["X-Query-Count"] = str(counter.count)
     return response
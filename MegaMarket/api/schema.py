@@ -20,6 +20,24 @@ class ShopUnitType(Enum):
         return self.value
 
 
+@unique
+class ImportJobStatus(Enum):
+    queued = "QUEUED"
+    running = "RUNNING"
+    done = "DONE"
+    failed = "FAILED"
+
+    def __str__(self):
+        return self.value
+
+
+@unique
+class StatisticBucket(Enum):
+    hour = "hour"
+    day = "day"
+    week = "week"
+
+
 class ShopUnit(BaseModel):
     id: str
     name: str
@@ -28,6 +46,10 @@ class ShopUnit(BaseModel):
     type: ShopUnitType
     price: int | None = None
     children: list[ShopUnit] | None
+    # Только при запросе с depth/limit/cursor: количество детей категории, если children обрезаны,
+    # и курсор следующей страницы детей запрошенного элемента
+    childrenCount: int | None
+    nextCursor: str | None
 
     class Config:
         json_encoders = {
@@ -78,6 +100,59 @@ class ShopUnitStatisticUnit(BaseModel):
 
 class ShopUnitStatisticResponse(BaseModel):
     items: list[ShopUnitStatisticUnit] = []
+    nextCursor: str | None  # Только при запросе с limit: курсор следующей страницы или null, если она последняя
+
+
+class ShopUnitStatisticBucket(BaseModel):
+    date: str  # Начало интервала
+    min: int | None = None
+    max: int | None = None
+    avg: float | None = None
+    last: int | None = None  # Цена после последнего обновления в интервале
+    count: int  # Количество обновлений в интервале
+
+
+class ShopUnitStatisticBucketsResponse(BaseModel):
+    items: list[ShopUnitStatisticBucket] = []
+
+
+class ImportJob(BaseModel):
+    id: int
+    status: ImportJobStatus
+    importId: int | None = None  # id импорта в журнале imports, после успешного выполнения
+    error: str | None = None  # Причина, по которой импорт не применён
+    createdAt: str
+    startedAt: str | None = None
+    finishedAt: str | None = None
+    duration: float | None = None  # Время выполнения в секундах
+
+    class Config:
+        json_encoders = {
+            ImportJobStatus: lambda v: str(v)
+        }
+
+
+class PoolStats(BaseModel):
+    pid: int
+    size: int
+    max_overflow: int
+    checked_in: int
+    checked_out: int
+    overflow: int
+    checkouts: int
+    checkout_timeouts: int
+    checkout_wait_total: float
+    checkout_wait_avg: float
+    checkout_wait_max: float
+
+
+class CacheStats(BaseModel):
+    size: int
+    max_size: int
+    hits: int
+    misses: int
+    evictions: int
+    invalidations: int
 
 
 class Error(BaseModel):
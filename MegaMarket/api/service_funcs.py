@@ -1,43 +1,40 @@
+import base64
 import re
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Iterable, Iterator
 
-from sqlalchemy.orm import Session
+import orjson
 
-from db.schema import ShopUnitsDB, ShopUnitUpdatesDB
+from sqlalchemy import select, update, delete, values, column, literal, bindparam, desc, any_, func, tuple_, \
+    union_all, case, text, String, Integer, BigInteger, DateTime, Float, Numeric
+from sqlalchemy.dialects.postgresql import insert, aggregate_order_by, ARRAY
+from sqlalchemy.engine import Row
+from sqlalchemy.sql import Select
+from sqlalchemy.ext.asyncio import AsyncSession, AsyncResult
+
+from db.schema import ShopUnitsDB, ShopUnitUpdatesDB, ShopUnitRollupsDB, ImportsDB, ImportJobsDB
+from .cache import INVALIDATION_CHANNEL, make_invalidation_message
 from .exceptions import InvalidImport, ElementIdException, IdExceptionsTypes
-from .schema import ShopUnitImport, ShopUnitType, ShopUnit, UUID_64_pattern
+from .schema import ShopUnitImport, ShopUnitType, StatisticBucket, ImportJobStatus, UUID_64_pattern
+from .validation import validate_import
+
+CATALOG_LOCK_ID = 1  # Ключ advisory блокировки, под которой меняется дерево каталога
+MAINTENANCE_LOCK_ID = 3  # Ключ advisory блокировки, под которой процессы по очереди обслуживают логи
+PATH_SEPARATOR = "/"  # Разделитель id в материализованном пути юнита
+MAX_QUERY_PARAMS = 32767  # Максимальное количество параметров в одном запросе asyncpg
+STREAM_BATCH_SIZE = 1000  # Сколько строк поддерева читать из курсора за раз при потоковой отдаче /nodes
+LOG_TABLE = "shop_units_update_logs"
+LOG_PARTITION_PREFIX = "shop_units_update_logs_p"  # Имя месячной секции логов - префикс и месяц в виде ГГГГММ
+DEFAULT_LOG_PARTITION = "shop_units_update_logs_default"  # Секция для логов вне созданных месячных секций
+STREAM_IDS_TABLE = "stream_import_ids"  # Временная таблица id потокового импорта для поиска повторов
 
 
-def from_pyschema_to_db_schema(item: ShopUnitImport, date: str,
-                               id_types_dict: dict[str, ShopUnitType], db: Session) -> ShopUnitsDB:
+def from_pyschema_to_db_schema(item: ShopUnitImport, date: datetime, units: dict[str, ShopUnitsDB]) -> ShopUnitsDB:
     """
-    Функция, которая валидирует полученный в реквесте юнит, и в случае
-    корректности данных возвращет схему длу базы данных
+    Функция, которая переводит полученный в реквесте юнит в схему для базы данных.
+    Импорт должен быть заранее проверен validate_import, в units лежат загруженные из БД юниты запроса
     """
-
-    # Проверка на то существует ли такой юнит уже в БД
-    update: ShopUnitsDB = db.query(ShopUnitsDB).filter(ShopUnitsDB.id == item.id).first()
-    if update is not None:
-        if item.type != update.type:  # Если такой юнит уже сущетсвует то изменять его тип запрещено
-            raise InvalidImport(message=f"При обновлении нельзя менять тип юнита: id={item.id}")
-    if item.parentId is not None:  # Проверка передаётся ли нам какой-то родительский id
-        if item.parentId in id_types_dict.keys():  # Проверка был ли такой id в запросе, который нам поступил
-            if id_types_dict[item.parentId] != ShopUnitType.category:  # Проверка на то, что родительский элемент категоория
-                raise InvalidImport(
-                    message=f"Такого родителя не существует или он не является категорией: id={item.id}")
-        else:
-            parent: ShopUnitsDB = db.query(ShopUnitsDB).filter(ShopUnitsDB.id == item.parentId).first()
-
-            # Если в запросе такого элемента не было, то проверяем его наличие в БД и то, что он является категорией
-            if parent is None or parent.type != ShopUnitType.category:
-                raise InvalidImport(
-                    message=f"Такого родителя не существует или он не является категорией: id={item.id}")
-
-    # Валидация цены
-    if item.type == ShopUnitType.category and item.price is not None:
-        raise InvalidImport(message=f"У категорий не должно быть цены: id={item.id}")
-    elif item.type == ShopUnitType.offer and (item.price is None or item.price < 0):
-        raise InvalidImport(message=f"У товаров должна быть цена, и она должна быть больше 0: id={item.id}")
-
+    update: ShopUnitsDB | None = units.get(item.id)
     if update is None:  # Создание схемы, если это не обновление
         update: ShopUnitsDB = ShopUnitsDB(
             id=item.id,
@@ -45,7 +42,10 @@ def from_pyschema_to_db_schema(item: ShopUnitImport, date: str,
             name=item.name,
             price=item.price,
             last_update=date,
-            parent_category=item.parentId
+            parent_category=item.parentId,
+            path=None,  # Путь проставится в update_paths, когда будут известны все родители запроса
+            offers_sum=0,
+            offers_count=0
         )
     else:  # Обновление схемы
         update.name = item.name
@@ -56,105 +56,892 @@ def from_pyschema_to_db_schema(item: ShopUnitImport, date: str,
     return update
 
 
-def delete_all_children(elem_id: str, db: Session):
-    """Функция, которая удаляет всех потомков элемента и все логи об обновлениях в БД"""
-    current_children: list[ShopUnitsDB] = db.query(ShopUnitsDB).filter(ShopUnitsDB.parent_category == elem_id).all()
-    for child in current_children:
-        db.query(ShopUnitUpdatesDB).filter(ShopUnitUpdatesDB.unit_id == child.id).delete()
-        db.commit()
-        delete_all_children(child.id, db)
-
-    db.query(ShopUnitsDB).filter(ShopUnitsDB.parent_category == elem_id).delete()
-    db.commit()
-    return
-
-
-def get_category_price(unit_id: str, db: Session, prices_list: list[int]) -> int | None:
-    """
-    Данная функция вычисляет цену катерогии, а именно проходит всех потомков,
-    и если потомок является товаром заносит его в список,
-    изначально нужно передать пустой список
-    """
-    children_list: list[ShopUnitsDB] = db.query(ShopUnitsDB).filter(ShopUnitsDB.parent_category == unit_id).all()
-    for child in children_list:
-        if child.type == ShopUnitType.offer:
-            prices_list.append(child.price)
-        elif child.type == ShopUnitType.category:
-            sub_children_list: list[ShopUnitsDB] = db.query(ShopUnitsDB).\
-                filter(ShopUnitsDB.parent_category == child.id).all()
-            if len(sub_children_list) > 0:
-                get_category_price(child.id, db, prices_list)
-
-    return sum(prices_list) // len(prices_list) if len(prices_list) > 0 else None
-
-
-def get_all_children(element_id: str, db: Session) -> list[ShopUnit]:
-    """Функция возвращает всех потомков элемента в виде списка ShopUnit"""
-    children: list[ShopUnitsDB] = db.query(ShopUnitsDB).filter(ShopUnitsDB.parent_category == element_id).all()
-    res_list: list[ShopUnit] = []
-    for child in children:
-        sub_children_list: list[ShopUnit] = get_all_children(child.id, db)
-        reformat: ShopUnit = ShopUnit(
-            id=child.id,
-            name=child.name,
-            date=child.last_update.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
-            parentId=child.parent_category,
-            type=child.type,
-            price=child.price if child.type == ShopUnitType.offer else get_category_price(child.id, db, []),
-            children=None if child.type == ShopUnitType.offer else sub_children_list
-        )
-        res_list.append(reformat)
-    return res_list
+async def get_subtree_ids(element_path: str, db: AsyncSession) -> list[str]:
+    """Функция одним диапазонным запросом по индексу path возвращает id элемента и всех его потомков"""
+    return list((await db.execute(select(ShopUnitsDB.id).
+                                  where(ShopUnitsDB.path.startswith(element_path, autoescape=True)))).scalars())
+
+
+async def delete_units(ids: list[str], db: AsyncSession) -> None:
+    """Функция удаляет юниты, все логи об их обновлениях и свёрнутые логи массовыми запросами без комита"""
+    ids_array = literal(ids, ARRAY(String))
+    await db.execute(delete(ShopUnitUpdatesDB.__table__).where(ShopUnitUpdatesDB.unit_id == any_(ids_array)))
+    await db.execute(delete(ShopUnitRollupsDB.__table__).where(ShopUnitRollupsDB.unit_id == any_(ids_array)))
+    await db.execute(delete(ShopUnitsDB.__table__).where(ShopUnitsDB.id == any_(ids_array)))
+
+
+def get_category_price(unit: ShopUnitsDB) -> int | None:
+    """Цена категории - средняя цена всех товаров поддерева, берётся из хранимых агрегатов"""
+    return unit.offers_sum // unit.offers_count if unit.offers_count > 0 else None
+
+
+def get_unit_contribution(unit: ShopUnitsDB, price: int | None = None) -> tuple[int, int]:
+    """
+    Вклад юнита в агрегаты предков: (сумма цен, количество товаров).
+    Для товара можно передать price, чтоб посчитать вклад со старой ценой
+    """
+    if unit.type == ShopUnitType.offer:
+        return (unit.price if price is None else price), 1
+    return unit.offers_sum, unit.offers_count
+
+
+def apply_aggregates_delta(parent_id: str | None, delta_sum: int, delta_count: int,
+                           units: dict[str, ShopUnitsDB], parents: dict[str, str | None] | None = None) -> None:
+    """
+    Функция прибавляет дельту к агрегатам всех предков начиная с parent_id.
+    Все предки должны быть заранее загружены в units (см. load_ancestors),
+    в parents - переопределённые на время пересчёта родители юнитов запроса
+    """
+    parents = parents if parents is not None else {}
+    visited: set[str] = set()
+    while parent_id is not None:
+        if parent_id in visited:
+            raise InvalidImport(message=f"Обнаружен цикл в иерархии категорий: id={parent_id}")
+        visited.add(parent_id)
+        parent: ShopUnitsDB | None = units.get(parent_id)
+        if parent is None:
+            return
+        parent.offers_sum += delta_sum
+        parent.offers_count += delta_count
+        parent_id = parents.get(parent.id, parent.parent_category)
+
+
+def update_aggregates(units: list[ShopUnitsDB], old_states: dict[str, tuple[str | None, int | None]],
+                      all_units: dict[str, ShopUnitsDB]) -> None:
+    """
+    Функция пересчитывает агрегаты категорий после импорта дельтами вдоль цепочек предков.
+    old_states хранит для уже существующих юнитов их старого родителя и старую цену.
+    Сначала все юниты запроса по очереди отцепляются от старых предков, затем прицепляются к новым,
+    поэтому вклад каждого товара учитывается ровно один раз, даже если в запросе переносятся вложенные категории
+    """
+    parents: dict[str, str | None] = {unit.id: old_states[unit.id][0] if unit.id in old_states else None
+                                      for unit in units}
+    for unit in units:  # Отцепляем юниты от старых предков
+        if unit.id not in old_states:
+            continue
+        old_parent, old_price = old_states[unit.id]
+        delta_sum, delta_count = get_unit_contribution(unit, old_price)
+        apply_aggregates_delta(old_parent, -delta_sum, -delta_count, all_units, parents)
+        parents[unit.id] = None
+
+    for unit in units:  # Прицепляем юниты к новым предкам
+        parents[unit.id] = unit.parent_category
+        delta_sum, delta_count = get_unit_contribution(unit)
+        apply_aggregates_delta(unit.parent_category, delta_sum, delta_count, all_units, parents)
+
+
+def make_node(row: Any, children: list[dict[str, Any]] | None) -> dict[str, Any]:
+    """
+    Узел ответа /nodes из строки shop_units в виде словаря с ключами в порядке полей ShopUnit,
+    чтоб сериализовать всё дерево в байты за один проход orjson без промежуточных pydantic моделей
+    """
+    return {
+        "id": row.id,
+        "name": row.name,
+        "date": row.last_update.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+        "parentId": row.parent_category,
+        "type": row.type.value,
+        "price": row.price if row.type == ShopUnitType.offer else get_category_price(row),
+        "children": children
+    }
+
+
+def make_statistic_unit(unit_id: str, name: str, parent_id: str | None, unit_type: ShopUnitType, price: int | None,
+                        date: datetime) -> dict[str, Any]:
+    """Элемент ответов /sales и /node/{id}/statistic в виде словаря с ключами в порядке полей ShopUnitStatisticUnit"""
+    return {
+        "id": unit_id,
+        "name": name,
+        "parentId": parent_id,
+        "type": unit_type.value,
+        "price": price,
+        "date": date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    }
+
+
+def encode_cursor(*key: Any) -> str:
+    """
+    Непрозрачный курсор постраничной выдачи из ключа сортировки последнего отданного элемента,
+    например (дата, id). Даты без часового пояса (логи хранят UTC без пояса) записываются как UTC
+    """
+    parts: list[Any] = [(part if part.tzinfo is not None else part.replace(tzinfo=timezone.utc)).isoformat()
+                        if isinstance(part, datetime) else part for part in key]
+    return base64.urlsafe_b64encode(orjson.dumps(parts)).decode()
+
+
+def decode_cursor(cursor: str, *key_types: type) -> tuple[Any, ...]:
+    """
+    Ключ сортировки из курсора encode_cursor с частями типов key_types. ValueError, если курсор невалидный,
+    количество или типы частей не те (курсор другой ручки) или дата в нём без часового пояса,
+    иначе такой ключ дошёл бы до SQL и упал там
+    """
+    try:
+        parts: Any = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(parts, list) or len(parts) != len(key_types):
+            raise ValueError("Wrong cursor key length")
+        key: tuple[Any, ...] = tuple(datetime.fromisoformat(part) if key_type is datetime else part
+                                     for part, key_type in zip(parts, key_types))
+    except (TypeError, ValueError, orjson.JSONDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if any(type(part) is not key_type or key_type is datetime and part.tzinfo is None
+           for part, key_type in zip(key, key_types)):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return key
+
+
+async def get_sales(date_from: datetime, date_to: datetime, limit: int | None, after: tuple[datetime, str] | None,
+                    db: AsyncSession) -> list[Row]:
+    """
+    Товары, обновлённые в [date_from, date_to], по порядку (last_update, id), начиная после ключа after.
+    Условие на тип подставляется в SQL литералом, чтоб планировщик мог использовать
+    частичный индекс по товарам и для закэшированных планов prepared statements
+    """
+    query = select(ShopUnitsDB.id, ShopUnitsDB.name, ShopUnitsDB.parent_category, ShopUnitsDB.type, ShopUnitsDB.price,
+                   ShopUnitsDB.last_update).\
+        where(ShopUnitsDB.type == bindparam(None, ShopUnitType.offer, ShopUnitsDB.type.type, literal_execute=True)).\
+        where(ShopUnitsDB.last_update >= date_from).where(ShopUnitsDB.last_update <= date_to)
+    if after is not None:
+        query = query.where(tuple_(ShopUnitsDB.last_update, ShopUnitsDB.id) > tuple_(*after))
+    query = query.order_by(ShopUnitsDB.last_update, ShopUnitsDB.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return (await db.execute(query)).all()
+
+
+def get_history_parts(unit_id: str, date_from: datetime, date_to: datetime) -> tuple[Select, Select]:
+    """
+    История юнита в [date_from, date_to) из двух источников: update логи и свёрнутые старые логи.
+    Свёрнутый интервал выглядит как одно обновление в момент последнего обновления в нём,
+    с последними именем, родителем и ценой. Его id отрицательный, чтоб ключ (update_date, id) не пересекался с логами
+    """
+    log, rollup = ShopUnitUpdatesDB, ShopUnitRollupsDB
+    logs = select(log.id, log.name, log.parent_category, log.price, log.update_date).\
+        where(log.unit_id == unit_id).where(log.update_date >= date_from).where(log.update_date < date_to)
+    rollups = select((-rollup.id).label("id"), rollup.last_name.label("name"),
+                     rollup.last_parent_category.label("parent_category"), rollup.last_price.label("price"),
+                     rollup.last_update_date.label("update_date")).\
+        where(rollup.unit_id == unit_id).\
+        where(rollup.last_update_date >= date_from).where(rollup.last_update_date < date_to)
+    return logs, rollups
+
+
+async def get_unit_history(unit_id: str, date_from: datetime, date_to: datetime, limit: int | None,
+                           after: tuple[datetime, int] | None, db: AsyncSession) -> list[Row]:
+    """
+    Обновления юнита в [date_from, date_to) по порядку (update_date, id), начиная после ключа after,
+    из логов и свёрнутых логов. Ключ и limit применяются в каждом источнике отдельно,
+    чтоб оба читались диапазоном по индексу (unit_id, дата, id), а сортировались только 2 * limit строк
+    """
+    parts: list[Select] = []
+    for part in get_history_parts(unit_id, date_from, date_to):
+        columns = part.selected_columns
+        if after is not None:
+            part = part.where(tuple_(columns.update_date, columns.id) > tuple_(*after))
+        if limit is not None:
+            part = part.order_by(columns.update_date, columns.id).limit(limit)
+        parts.append(part)
+    history = union_all(*parts).subquery()
+    query = select(history).order_by(history.c.update_date, history.c.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return (await db.execute(query)).all()
 
 
-def get_element_with_validation(element_id: str, db: Session) -> ShopUnitsDB:
+async def get_unit_history_buckets(unit_id: str, date_from: datetime, date_to: datetime, bucket: StatisticBucket,
+                                   db: AsyncSession) -> list[dict[str, Any]]:
+    """
+    История цены юнита в [date_from, date_to), агрегированная в SQL по интервалам bucket:
+    минимальная, максимальная, средняя и последняя цена и количество обновлений в каждом интервале.
+    Свёрнутые логи попадают в интервал по началу своего интервала, поэтому для них интервалы
+    мельче интервала свёртки не различаются
+    """
+    log, rollup = ShopUnitUpdatesDB, ShopUnitRollupsDB
+    price_count = case((log.price.is_(None), 0), else_=1)
+    history = union_all(
+        select(log.update_date.label("bucket_date"), log.update_date, log.id, log.price.label("min_price"),
+               log.price.label("max_price"), func.coalesce(log.price, 0).label("price_sum"),
+               price_count.label("price_count"), literal(1).label("updates_count"), log.price.label("last_price")).
+        where(log.unit_id == unit_id).where(log.update_date >= date_from).where(log.update_date < date_to),
+        select(rollup.bucket_start, rollup.last_update_date, -rollup.id, rollup.min_price, rollup.max_price,
+               rollup.price_sum, rollup.price_count, rollup.updates_count, rollup.last_price).
+        where(rollup.unit_id == unit_id).
+        where(rollup.last_update_date >= date_from).where(rollup.last_update_date < date_to)
+    ).subquery()
+    # Название интервала подставляется литералом, чтоб выражение в SELECT и GROUP BY совпадало текстом
+    bucket_start = func.date_trunc(bindparam(None, bucket.value, String, literal_execute=True), history.c.bucket_date)
+    rows = (await db.execute(
+        select(bucket_start.label("bucket_start"),
+               func.min(history.c.min_price), func.max(history.c.max_price),
+               (func.sum(history.c.price_sum).cast(Numeric) / func.nullif(func.sum(history.c.price_count), 0)).
+               cast(Float),
+               (func.array_agg(aggregate_order_by(history.c.last_price, history.c.update_date.desc(),
+                                                  history.c.id.desc())))[1],
+               func.sum(history.c.updates_count)).
+        group_by(bucket_start).order_by(bucket_start)
+    )).all()
+    return [
+        {
+            "date": start.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "min": min_price,
+            "max": max_price,
+            "avg": avg_price,
+            "last": last_price,
+            "count": count
+        }
+        for start, min_price, max_price, avg_price, last_price, count in rows
+    ]
+
+
+async def get_subtree(element_path: str, db: AsyncSession) -> dict[str, Any] | None:
+    """
+    Функция одним диапазонным запросом по индексу path достаёт элемент со всеми потомками и собирает
+    из них дерево ответа (см. make_node) снизу вверх, цены категорий берутся из хранимых агрегатов.
+    Возвращает None, если элемента нет в БД
+    """
+    rows = (await db.execute(select(ShopUnitsDB.__table__).
+                             where(ShopUnitsDB.path.startswith(element_path, autoescape=True)).
+                             order_by(desc(ShopUnitsDB.path)))).all()
+
+    children: dict[str, list[dict[str, Any]]] = {}  # Уже собранные потомки, сгруппированные по id родителя
+    node: dict[str, Any] | None = None
+    for row in rows:  # При сортировке path по убыванию все потомки юнита идут раньше него самого
+        # Потомки собраны по убыванию path, разворачиваем их, чтоб порядок совпадал с потоковой отдачей
+        node = make_node(row, None if row.type == ShopUnitType.offer else children.pop(row.id, [])[::-1])
+        children.setdefault(row.parent_category, []).append(node)
+    return node
+
+
+async def stream_subtree(element_path: str, db: AsyncSession) -> AsyncIterator[bytes] | None:
+    """
+    Функция открывает серверный курсор по поддереву элемента в порядке обхода в глубину (path по возрастанию)
+    и возвращает генератор JSON ответа /nodes, который читает курсор кусками по STREAM_BATCH_SIZE строк.
+    Возвращает None, если элемента нет в БД
+    """
+    result: AsyncResult = await db.stream(select(ShopUnitsDB.__table__).
+                                          where(ShopUnitsDB.path.startswith(element_path, autoescape=True)).
+                                          order_by(ShopUnitsDB.path))
+    rows: list[Row] = await result.fetchmany(STREAM_BATCH_SIZE)
+    if not rows:
+        await result.close()
+        return None
+    return encode_subtree(rows, result)
+
+
+async def encode_subtree(rows: list[Row], result: AsyncResult) -> AsyncIterator[bytes]:
+    """
+    Генератор JSON дерева ответа /nodes из строк поддерева в порядке обхода в глубину.
+    Узел пишется сразу, как только прочитан, а children категории остаются открытыми, пока не придёт
+    строка вне её поддерева, поэтому в памяти держится только стек открытых категорий глубиной с дерево
+    """
+    stack: list[list] = []  # Открытые категории: [id, записан ли уже хоть один потомок]
+    while rows:
+        chunk: list[bytes] = []
+        for row in rows:
+            while stack and stack[-1][0] != row.parent_category:  # Поддеревья, которые закончились
+                stack.pop()
+                chunk.append(b"]}")
+            if stack:
+                if stack[-1][1]:
+                    chunk.append(b",")
+                stack[-1][1] = True
+            if row.type == ShopUnitType.offer:
+                chunk.append(orjson.dumps(make_node(row, None)))
+            else:  # Без закрывающих "]}", потомки категории допишутся следом
+                chunk.append(orjson.dumps(make_node(row, []))[:-2])
+                stack.append([row.id, False])
+        yield b"".join(chunk)
+        rows = await result.fetchmany(STREAM_BATCH_SIZE)
+    yield b"]}" * len(stack)
+
+
+async def get_children_counts(ids: list[str], db: AsyncSession) -> dict[str, int]:
+    """Количество прямых детей у каждой категории из ids одним запросом по индексу (parent_category, id)"""
+    rows = (await db.execute(select(ShopUnitsDB.parent_category, func.count()).
+                             where(ShopUnitsDB.parent_category == any_(literal(ids, ARRAY(String)))).
+                             group_by(ShopUnitsDB.parent_category))).all()
+    return {parent_id: count for parent_id, count in rows}
+
+
+async def get_subtree_levels(element: ShopUnitsDB, depth: int | None, limit: int | None, after: str | None,
+                             db: AsyncSession) -> dict[str, Any]:
+    """
+    Функция собирает дерево ответа /nodes не глубже depth уровней под элементом, по запросу на уровень
+    через индекс (parent_category, id). Дети элемента отдаются страницей из limit штук с id больше after
+    и курсором nextCursor на следующую страницу из id последнего ребёнка. У категорий на последнем уровне
+    children равен None, а в childrenCount лежит количество их детей.
+    Цены категорий берутся из агрегатов по всему поддереву
+    """
+    root: dict[str, Any] = make_node(element, None)
+    if element.type == ShopUnitType.offer:
+        return root
+
+    level_ids: list[str] = [element.id]
+    nodes: dict[str, dict[str, Any]] = {element.id: root}  # Категории текущего уровня
+    level: int = 0
+    while level_ids and (depth is None or level < depth):
+        query = select(ShopUnitsDB.__table__).\
+            where(ShopUnitsDB.parent_category == any_(literal(level_ids, ARRAY(String))))
+        if level == 0:  # Страница детей самого элемента
+            if after is not None:
+                query = query.where(ShopUnitsDB.id > after)
+            if limit is not None:
+                query = query.limit(limit + 1)
+        rows = (await db.execute(query.order_by(ShopUnitsDB.parent_category, ShopUnitsDB.id))).all()
+        if level == 0 and (limit is not None or after is not None):
+            root["childrenCount"] = (await get_children_counts([element.id], db)).get(element.id, 0)
+            root["nextCursor"] = encode_cursor(rows[limit - 1].id) if limit is not None and len(rows) > limit else None
+            rows = rows[:limit]
+        for node in nodes.values():
+            node["children"] = []
+        next_nodes: dict[str, dict[str, Any]] = {}
+        for row in rows:
+            node: dict[str, Any] = make_node(row, None)
+            nodes[row.parent_category]["children"].append(node)
+            if row.type == ShopUnitType.category:
+                next_nodes[row.id] = node
+        nodes, level_ids = next_nodes, list(next_nodes)
+        level += 1
+
+    if level_ids:  # Категории последнего уровня, дальше которого дерево обрезано по depth
+        counts: dict[str, int] = await get_children_counts(level_ids, db)
+        for node_id, node in nodes.items():
+            node["childrenCount"] = counts.get(node_id, 0)
+    return root
+
+
+async def get_element_with_validation(element_id: str, db: AsyncSession) -> ShopUnitsDB:
     """Данная функция нужна чтоб взять элемент из БД и проверить корректность переданного ID и его наличие в БД"""
     if not re.fullmatch(UUID_64_pattern, element_id):
         raise ElementIdException(IdExceptionsTypes.uuid)
-    element: ShopUnitsDB = db.query(ShopUnitsDB).filter(ShopUnitsDB.id == element_id).first()
+    element: ShopUnitsDB | None = (await db.execute(select(ShopUnitsDB).where(ShopUnitsDB.id == element_id))).\
+        scalars().first()
     if element is None:
         raise ElementIdException(IdExceptionsTypes.not_found)
     return element
 
 
-def update_parents(parent_id: str, date: str, import_id: int, db: Session) -> None:
-    """Данна функция обновляет дату всех предков, и создаёт логи об их обновлениях"""
-    parent: ShopUnitsDB = db.query(ShopUnitsDB).filter(ShopUnitsDB.id == parent_id).first()
-    if parent is None:
+def update_parents(parent_id: str | None, date: datetime, units: dict[str, ShopUnitsDB]) -> list[ShopUnitsDB]:
+    """
+    Данна функция обновляет дату всех предков в памяти и возвращает их, начиная с корня,
+    для последующей записи и создания логов об их обновлениях
+    """
+    parents: list[ShopUnitsDB] = []
+    while parent_id is not None and parent_id in units:
+        parent: ShopUnitsDB = units[parent_id]
+        parent.last_update = date
+        parents.append(parent)
+        parent_id = parent.parent_category
+        if len(parents) > len(units):
+            raise InvalidImport(message=f"Обнаружен цикл в иерархии категорий: id={parent_id}")
+    parents.reverse()
+    return parents
+
+
+def make_update_log(inst: ShopUnitsDB, import_id: int) -> dict[str, Any]:
+    """Функция для создания лога об обновлении элемента, возвращает строку для массовой вставки"""
+    return {
+        "unit_id": inst.id,
+        "name": inst.name,
+        "price": inst.price if inst.type == ShopUnitType.offer else get_category_price(inst),
+        "parent_category": inst.parent_category,
+        # Колонка update_date в логах без таймзоны, asyncpg принимает для неё только naive datetime в UTC
+        "update_date": inst.last_update.astimezone(timezone.utc).replace(tzinfo=None),
+        "import_request_id": import_id
+    }
+
+
+async def create_import(update_date: datetime, items_count: int, db: AsyncSession) -> ImportsDB:
+    """
+    Функция регистрирует новый импорт в таблице imports и возвращает его запись.
+    id выдаётся последовательностью БД, поэтому параллельные импорты никогда не получат одинаковый id
+    """
+    record: ImportsDB = ImportsDB(update_date=update_date, items_count=items_count)
+    db.add(record)
+    await db.flush()
+    return record
+
+
+async def create_import_job(payload: dict[str, Any], db: AsyncSession) -> ImportJobsDB:
+    """Постановка тела запроса /imports в очередь import_jobs без комита, возвращает задачу с выданным id"""
+    job: ImportJobsDB = ImportJobsDB(status=ImportJobStatus.queued, payload=payload)
+    db.add(job)
+    await db.flush()
+    return job
+
+
+async def get_import_job(job_id: int, db: AsyncSession) -> ImportJobsDB | None:
+    return (await db.execute(select(ImportJobsDB).where(ImportJobsDB.id == job_id))).scalars().first()
+
+
+async def get_next_import_job(db: AsyncSession) -> ImportJobsDB | None:
+    """
+    Самая старая невыполненная задача очереди. Задача в статусе running тоже выбирается:
+    значит воркер, который её выполнял, упал, и его транзакция откатилась
+    """
+    pending = bindparam(None, [ImportJobStatus.queued, ImportJobStatus.running], ImportJobsDB.status.type,
+                        expanding=True, literal_execute=True)  # Литералом, чтоб подходил частичный индекс
+    return (await db.execute(select(ImportJobsDB).where(ImportJobsDB.status.in_(pending)).
+                             order_by(ImportJobsDB.id).limit(1))).scalars().first()
+
+
+async def start_import_job(job_id: int, db: AsyncSession) -> None:
+    """
+    Перевод задачи из очереди в running без комита. Задачу, которую уже выполняет
+    или выполнил воркер другого процесса, не трогает
+    """
+    await db.execute(update(ImportJobsDB.__table__).
+                     where(ImportJobsDB.id == job_id, ImportJobsDB.status == ImportJobStatus.queued).
+                     values(status=ImportJobStatus.running, started_at=func.now()))
+
+
+async def count_import_job_failure(job_id: int, db: AsyncSession) -> int:
+    """Учёт попытки задачи, упавшей не из-за данных, без комита, возвращает количество таких попыток"""
+    return (await db.execute(update(ImportJobsDB.__table__).where(ImportJobsDB.id == job_id).
+                             values(attempts=ImportJobsDB.attempts + 1).returning(ImportJobsDB.attempts))).scalar()
+
+
+async def set_import_job_status(job_id: int, status: ImportJobStatus, db: AsyncSession, **fields: Any) -> None:
+    """Смена статуса задачи и других её полей без комита"""
+    await db.execute(update(ImportJobsDB.__table__).where(ImportJobsDB.id == job_id).values(status=status, **fields))
+
+
+def make_import_job(job: ImportJobsDB) -> dict[str, Any]:
+    """Ответ о состоянии задачи в виде словаря с ключами в порядке полей ImportJob"""
+    return {
+        "id": job.id,
+        "status": job.status.value,
+        "importId": job.import_id,
+        "error": job.error,
+        "createdAt": job.created_at.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+        "startedAt": job.started_at.strftime("%Y-%m-%dT%H:%M:%S.000Z") if job.started_at is not None else None,
+        "finishedAt": job.finished_at.strftime("%Y-%m-%dT%H:%M:%S.000Z") if job.finished_at is not None else None,
+        "duration": (job.finished_at - job.started_at).total_seconds()
+        if job.started_at is not None and job.finished_at is not None else None
+    }
+
+
+async def lock_catalog(db: AsyncSession) -> None:
+    """
+    Берёт транзакционную advisory блокировку каталога: импорты и удаления меняют агрегаты предков
+    по прочитанным значениям, поэтому должны выполняться строго по очереди
+    """
+    await db.execute(select(func.pg_advisory_xact_lock(CATALOG_LOCK_ID)))
+
+
+async def publish_invalidation(ids: Iterable[str] | None, db: AsyncSession) -> None:
+    """
+    NOTIFY для кэшей /nodes всех воркеров об изменившихся поддеревьях, None - сбросить кэши целиком.
+    Вызывается до комита: уведомление доставляется только при комите транзакции и пропадает при откате
+    """
+    await db.execute(select(func.pg_notify(INVALIDATION_CHANNEL, make_invalidation_message(ids))))
+
+
+def get_path_ids(path: str) -> list[str]:
+    """Список id из материализованного пути, начиная с корня и заканчивая самим юнитом"""
+    return path.split(PATH_SEPARATOR)[:-1]
+
+
+async def get_units_with_ancestors(ids: set[str], db: AsyncSession) -> dict[str, ShopUnitsDB]:
+    """
+    Функция достаёт юниты по набору id вместе со всеми их предками (их id берутся из path)
+    двумя запросами по первичному ключу и возвращает их копии, не привязанные к сессии,
+    чтобы изменения в памяти попадали в БД только через save_units и update_units
+    """
+    units: dict[str, ShopUnitsDB] = {}
+    while ids:
+        ids_array = literal(list(ids), ARRAY(String))  # Один параметр-массив вместо параметра на каждый id
+        rows = (await db.execute(select(ShopUnitsDB.__table__).where(ShopUnitsDB.id == any_(ids_array)))).all()
+        units.update({row.id: ShopUnitsDB(**row._mapping) for row in rows})
+        ids = {ancestor_id for row in rows for ancestor_id in get_path_ids(row.path)} - units.keys()
+    return units
+
+
+def update_paths(units: dict[str, ShopUnitsDB]) -> list[tuple[str, str]]:
+    """
+    Функция пересчитывает в памяти path всех загруженных юнитов по их текущим родителям.
+    Возвращает пары (старый path, новый path) категорий, сменивших родителя, отсортированные
+    от самых глубоких к корню, для переноса их поддеревьев в БД через move_subtrees
+    """
+    new_paths: dict[str, str] = {}
+    for unit in units.values():
+        chain: list[ShopUnitsDB] = []  # Юниты от текущего вверх до первого с уже посчитанным path
+        current: ShopUnitsDB | None = unit
+        while current is not None and current.id not in new_paths:
+            if len(chain) > len(units):
+                raise InvalidImport(message=f"Обнаружен цикл в иерархии категорий: id={unit.id}")
+            chain.append(current)
+            current = units.get(current.parent_category) if current.parent_category is not None else None
+        prefix: str = new_paths[current.id] if current is not None else ""
+        for node in reversed(chain):
+            prefix = new_paths[node.id] = prefix + node.id + PATH_SEPARATOR
+
+    moves: list[tuple[str, str]] = []
+    for unit in units.values():
+        if unit.path is not None and unit.type == ShopUnitType.category:  # Уже существующая категория
+            path_ids: list[str] = get_path_ids(unit.path)
+            old_parent: str | None = path_ids[-2] if len(path_ids) > 1 else None
+            if old_parent != unit.parent_category:
+                moves.append((unit.path, new_paths[unit.id]))
+        unit.path = new_paths[unit.id]
+    moves.sort(key=lambda move: move[0].count(PATH_SEPARATOR), reverse=True)
+    return moves
+
+
+async def move_subtrees(moves: list[tuple[str, str]], db: AsyncSession) -> None:
+    """
+    Функция переписывает префикс path у всех потомков перенесённых категорий, по запросу на категорию.
+    Переносы должны идти от самых глубоких категорий, тогда уже переписанные пути
+    не совпадают со старыми префиксами вышестоящих категорий
+    """
+    for old_path, new_path in moves:
+        await db.execute(update(ShopUnitsDB.__table__).
+                         where(ShopUnitsDB.path.startswith(old_path, autoescape=True)).
+                         values(path=literal(new_path) + func.substr(ShopUnitsDB.path, len(old_path) + 1)))
+
+
+def unit_to_row(unit: ShopUnitsDB) -> dict[str, Any]:
+    """Словарь со значениями всех колонок юнита для массовой записи"""
+    return {column.key: getattr(unit, column.key) for column in ShopUnitsDB.__table__.columns}
+
+
+def chunked(rows: list, columns_count: int) -> Iterator[list]:
+    """Делит строки массовой записи на куски, в каждом из которых параметров не больше MAX_QUERY_PARAMS"""
+    size: int = MAX_QUERY_PARAMS // columns_count
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+async def save_units(units: list[ShopUnitsDB], db: AsyncSession) -> None:
+    """
+    Массовая вставка/обновление юнитов без комита: один подготовленный INSERT ... ON CONFLICT DO UPDATE
+    выполняется через executemany, вместо компиляции многострочного VALUES на каждый кусок строк
+    """
+    if not units:
         return
+    table = ShopUnitsDB.__table__
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.id],
+        set_={column.name: statement.excluded[column.name] for column in table.columns if not column.primary_key}
+    )
+    await db.execute(statement, [unit_to_row(unit) for unit in units])
+
 
-    parent.last_update = date
-    if parent.parent_category is not None:
-        update_parents(parent.parent_category, date, import_id, db)
-    add_and_refresh_db(parent, db)
-    make_update_log(parent, import_id, db)
-    return
+async def update_units(units: list[ShopUnitsDB], db: AsyncSession) -> None:
+    """
+    Обновление даты и агрегатов у набора уже существующих юнитов (предков) запросами
+    UPDATE ... FROM (VALUES ...) без комита
+    """
+    table = ShopUnitsDB.__table__
+    for chunk in chunked(units, 4):
+        new_values = values(
+            column("id", String), column("last_update", DateTime(timezone=True)),
+            column("offers_sum", BigInteger), column("offers_count", Integer),
+            name="new_values"
+        ).data([(unit.id, unit.last_update, unit.offers_sum, unit.offers_count) for unit in chunk])
+        await db.execute(
+            update(table).where(table.c.id == new_values.c.id).values(
+                last_update=new_values.c.last_update,
+                offers_sum=new_values.c.offers_sum,
+                offers_count=new_values.c.offers_count
+            )
+        )
 
 
-def make_update_log(inst: ShopUnitsDB, import_id: int, db: Session) -> None:
-    """Функция для создания лога об обновлении элемента"""
-    check_duplicate: ShopUnitUpdatesDB = db.query(ShopUnitUpdatesDB).filter(ShopUnitUpdatesDB.unit_id == inst.id).\
-        filter(ShopUnitUpdatesDB.import_request_id == import_id).first()
-    if check_duplicate is not None:  # Проверяем сделали ли мы уже для данного юнит апдейт лог, если да, то пропускаем
+async def save_logs(logs: list[dict[str, Any]], db: AsyncSession) -> None:
+    """
+    Массовая вставка update логов одним подготовленным INSERT через executemany без комита.
+    Повторный лог юнита в рамках одного импорта (категория, которую меняют несколько пачек потокового импорта)
+    по уникальному индексу (unit_id, import_request_id, update_date) заменяет прежний,
+    в истории остаётся итоговое состояние юнита
+    """
+    if not logs:
         return
-    logDB: ShopUnitUpdatesDB = ShopUnitUpdatesDB(
-        unit_id=inst.id,
-        name=inst.name,
-        price=inst.price if inst.type == ShopUnitType.offer else get_category_price(inst.id, db, []),
-        parent_category=inst.parent_category,
-        update_date=inst.last_update,
-        import_request_id=import_id
+    table = ShopUnitUpdatesDB.__table__
+    statement = insert(table)
+    await db.execute(statement.on_conflict_do_update(
+        index_elements=[table.c.unit_id, table.c.import_request_id, table.c.update_date],
+        set_={name: statement.excluded[name] for name in ("name", "price", "parent_category")}
+    ), logs)
+
+
+def get_month_start(date: datetime) -> datetime:
+    return date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def get_log_partition_name(month: datetime) -> str:
+    return f"{LOG_PARTITION_PREFIX}{month:%Y%m}"
+
+
+def get_upcoming_months(now: datetime, ahead: int) -> set[datetime]:
+    """Начала текущего и следующих ahead месяцев"""
+    months: list[datetime] = [get_month_start(now)]
+    for _ in range(ahead):
+        months.append(get_month_start(months[-1] + timedelta(days=32)))
+    return set(months)
+
+
+def make_log_partition_bounds(month: datetime) -> str:
+    next_month: datetime = get_month_start(month + timedelta(days=32))
+    return f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month:%Y-%m-%d}')"
+
+
+def make_log_partition_sql(month: datetime, parent: str = LOG_TABLE) -> str:
+    """DDL месячной секции логов, начинающейся с month, для таблиц, в которые ещё не пишут (миграции)"""
+    return f'CREATE TABLE IF NOT EXISTS "{get_log_partition_name(month)}" PARTITION OF {parent} ' \
+           f"{make_log_partition_bounds(month)}"
+
+
+def make_default_log_partition_sql(parent: str = LOG_TABLE) -> str:
+    return f"CREATE TABLE IF NOT EXISTS {DEFAULT_LOG_PARTITION} PARTITION OF {parent} DEFAULT"
+
+
+async def lock_maintenance(lock_timeout: float, db: AsyncSession) -> None:
+    """
+    Берёт транзакционную advisory блокировку обслуживания логов, под которой процессы выполняют его шаги по очереди,
+    не трогая блокировку каталога. Ожидание табличных блокировок шага ограничивается lock_timeout секундами,
+    чтоб чтение и запись логов не вставали в очередь за DDL обслуживания, которое само ждёт долгий импорт
+    """
+    await db.execute(select(func.pg_advisory_xact_lock(MAINTENANCE_LOCK_ID)))
+    await db.execute(select(func.set_config("lock_timeout", f"{int(lock_timeout * 1000)}ms", True)))
+
+
+async def get_log_partitions(db: AsyncSession) -> dict[str, datetime]:
+    """Месячные секции логов и начала их месяцев"""
+    names = (await db.execute(text(f"""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = '{LOG_TABLE}'::regclass AND starts_with(c.relname, :prefix)
+    """), {"prefix": LOG_PARTITION_PREFIX})).scalars().all()
+    return {name: datetime.strptime(name[len(LOG_PARTITION_PREFIX):], "%Y%m") for name in names}
+
+
+async def get_missing_log_partitions(now: datetime, ahead: int, db: AsyncSession) -> list[datetime]:
+    """
+    Месяцы, для которых нужно создать секции логов: текущий и следующие ahead, чтоб DDL не выполнялся
+    в транзакциях импортов, и месяцы логов, попавших в секцию по умолчанию (импорты с датами вне созданных секций)
+    """
+    months: set[datetime] = get_upcoming_months(now, ahead)
+    months.update((await db.execute(text(f"SELECT DISTINCT date_trunc('month', update_date) "
+                                         f"FROM {DEFAULT_LOG_PARTITION}"))).scalars())
+    months.difference_update((await get_log_partitions(db)).values())
+    return sorted(months)
+
+
+async def create_log_partition(month: datetime, db: AsyncSession) -> None:
+    """
+    Создание месячной секции логов, начинающейся с month, без комита. Секция создаётся отдельной таблицей
+    с CHECK по границам месяца и подключается ATTACH PARTITION, который в отличие от CREATE TABLE ... PARTITION OF
+    берёт на таблицу логов только SHARE UPDATE EXCLUSIVE, а благодаря CHECK не сканирует новую секцию.
+    Секцию по умолчанию ATTACH блокирует ACCESS EXCLUSIVE и сканирует, а логи месяца, перенесённые из неё
+    в новую секцию, заблокированы до комита, поэтому каждая секция создаётся отдельной короткой транзакцией
+    под lock_maintenance, вне блокировки каталога
+    """
+    name: str = get_log_partition_name(month)
+    if (await db.execute(select(func.to_regclass(name).isnot(None)))).scalar():
+        return
+    next_month: datetime = get_month_start(month + timedelta(days=32))
+    await db.execute(text(
+        f'CREATE TABLE "{name}" (LIKE {LOG_TABLE} INCLUDING DEFAULTS, CONSTRAINT "{name}_bounds" '
+        f"CHECK (update_date >= '{month:%Y-%m-%d}' AND update_date < '{next_month:%Y-%m-%d}'))"
+    ))
+    await db.execute(text(f"""
+        WITH moved AS (
+            DELETE FROM {DEFAULT_LOG_PARTITION} WHERE update_date >= :month AND update_date < :next_month
+            RETURNING *
+        )
+        INSERT INTO "{name}" SELECT * FROM moved
+    """), {"month": month, "next_month": next_month})
+    await db.execute(text(f'ALTER TABLE {LOG_TABLE} ATTACH PARTITION "{name}" {make_log_partition_bounds(month)}'))
+
+
+async def get_compaction_months(before: datetime, bucket: StatisticBucket,
+                                db: AsyncSession) -> tuple[datetime, list[datetime]]:
+    """
+    Граница свёртки логов - before, округлённый вниз до начала интервала bucket, чтоб сворачивались только
+    законченные интервалы, - и месяцы, в которых есть логи старше неё: месячные секции, начавшиеся до границы,
+    и месяцы старых логов в секции по умолчанию
+    """
+    bucket_name = bindparam(None, bucket.value, String, literal_execute=True)
+    before = (await db.execute(select(func.date_trunc(bucket_name, literal(before, DateTime))))).scalar()
+    months: set[datetime] = {month for month in (await get_log_partitions(db)).values() if month < before}
+    months.update((await db.execute(text(f"SELECT DISTINCT date_trunc('month', update_date) "
+                                         f"FROM {DEFAULT_LOG_PARTITION} WHERE update_date < :before"),
+                                    {"before": before})).scalars())
+    return before, sorted(months)
+
+
+async def compact_logs(month: datetime, before: datetime, bucket: StatisticBucket, db: AsyncSession) -> None:
+    """
+    Свёртка update логов месяца month старше before в shop_units_update_rollups по интервалам bucket без комита.
+    Логи удаляются и сворачиваются одним запросом DELETE ... RETURNING в одном снимке, так что лог, который импорт
+    запишет в этот месяц во время свёртки, не удалится несвёрнутым, а дождётся следующего прохода.
+    Удаляемые логи заблокированы до комита, поэтому каждый месяц сворачивается отдельной транзакцией.
+    Логи, пришедшие в уже свёрнутый интервал позже (импорт со старой датой), сливаются с его строкой
+    """
+    bucket_name = bindparam(None, bucket.value, String, literal_execute=True)
+    logs, table = ShopUnitUpdatesDB.__table__, ShopUnitRollupsDB.__table__
+    end: datetime = min(get_month_start(month + timedelta(days=32)), before)
+    moved = delete(logs).where(logs.c.update_date >= month, logs.c.update_date < end).returning(*logs.c).cte("moved")
+
+    def last(value):  # Значение из самого позднего лога интервала
+        return (func.array_agg(aggregate_order_by(value, moved.c.update_date.desc(), moved.c.id.desc())))[1]
+
+    bucket_start = func.date_trunc(bucket_name, moved.c.update_date)
+    statement = insert(table).from_select(
+        ["unit_id", "bucket_start", "min_price", "max_price", "price_sum", "price_count", "updates_count",
+         "last_name", "last_parent_category", "last_price", "last_update_date"],
+        select(moved.c.unit_id, bucket_start, func.min(moved.c.price), func.max(moved.c.price),
+               func.coalesce(func.sum(moved.c.price), 0), func.count(moved.c.price), func.count(),
+               last(moved.c.name), last(moved.c.parent_category), last(moved.c.price), func.max(moved.c.update_date)).
+        group_by(moved.c.unit_id, bucket_start)
+    ).add_cte(moved)
+    excluded = statement.excluded
+    is_newer = excluded.last_update_date >= table.c.last_update_date
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.unit_id, table.c.bucket_start],
+        set_={
+            "min_price": func.least(table.c.min_price, excluded.min_price),  # least и greatest пропускают NULL
+            "max_price": func.greatest(table.c.max_price, excluded.max_price),
+            "price_sum": table.c.price_sum + excluded.price_sum,
+            "price_count": table.c.price_count + excluded.price_count,
+            "updates_count": table.c.updates_count + excluded.updates_count,
+            "last_name": case((is_newer, excluded.last_name), else_=table.c.last_name),
+            "last_parent_category": case((is_newer, excluded.last_parent_category),
+                                         else_=table.c.last_parent_category),
+            "last_price": case((is_newer, excluded.last_price), else_=table.c.last_price),
+            "last_update_date": func.greatest(table.c.last_update_date, excluded.last_update_date)
+        }
     )
-    add_and_refresh_db(logDB, db)
-    return
+    await db.execute(statement)
+
+
+async def get_expired_log_partitions(before: datetime, db: AsyncSession) -> list[str]:
+    """Месячные секции логов, целиком старше границы свёртки before"""
+    return sorted(name for name, month in (await get_log_partitions(db)).items()
+                  if get_month_start(month + timedelta(days=32)) <= before)
+
+
+async def drop_log_partition(name: str, db: AsyncSession) -> None:
+    """
+    Удаление месячной секции логов, уже свёрнутой compact_logs, без комита. DROP секции блокирует всю таблицу
+    логов ACCESS EXCLUSIVE, поэтому она берётся первой, до любых других блокировок транзакции, а секция
+    удаляется, только если импорт со старой датой не успел записать в неё логи после свёртки
+    """
+    if not (await db.execute(select(func.to_regclass(name).isnot(None)))).scalar():
+        return
+    await db.execute(text(f"LOCK TABLE {LOG_TABLE} IN ACCESS EXCLUSIVE MODE"))
+    if not (await db.execute(text(f'SELECT EXISTS (SELECT FROM "{name}")'))).scalar():
+        await db.execute(text(f'DROP TABLE "{name}"'))
+
+
+async def iter_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator[Any]:
+    """Разбор тела NDJSON по мере получения: по одному объекту на непустую строку, в памяти только текущая строка"""
+    buffer: bytes = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield orjson.loads(line)
+    if buffer.strip():
+        yield orjson.loads(buffer)
+
+
+def split_resolved(items: list[ShopUnitImport], units: dict[str, ShopUnitsDB]) -> tuple[list[ShopUnitImport],
+                                                                                       list[ShopUnitImport]]:
+    """
+    Делит пачку потокового импорта на юниты, вся цепочка родителей которых уже есть в БД или в пачке,
+    и юниты, ссылающиеся на ещё не пришедших родителей. Вторые откладываются до следующих пачек
+    """
+    by_id: dict[str, ShopUnitImport] = {item.id: item for item in items}
+    resolved: dict[str, bool] = {}
+    for item in items:
+        chain: list[str] = []  # id от текущего вверх до первого с уже известным результатом
+        current: ShopUnitImport = item
+        result: bool = False
+        while current.id not in resolved and current.id not in chain:
+            chain.append(current.id)
+            if current.parentId is None or current.parentId in units:
+                result = True
+                break
+            if current.parentId not in by_id:
+                break
+            current = by_id[current.parentId]
+        else:  # Дошли до юнита с известным результатом или до цикла, который не разрешится никогда
+            result = resolved.get(current.id, False)
+        for unit_id in chain:
+            resolved[unit_id] = result
+    return [item for item in items if resolved[item.id]], [item for item in items if not resolved[item.id]]
+
+
+async def import_batch(items: list[ShopUnitImport], update_date: datetime, import_id: int, db: AsyncSession,
+                       defer_unresolved: bool = False) -> tuple[set[str], list[ShopUnitImport]]:
+    """
+    Валидация и запись импорта без комита, общая для /imports, /imports/stream и воркера очереди импортов.
+    Юниты запроса и их родители, затем их предки по id из materialized path загружаются двумя запросами
+    по первичному ключу и проверяются в памяти. Юниты записываются одним upsert, изменившиеся предки - одним UPDATE,
+    логи товаров и категорий - одним INSERT. Пачка потокового импорта читает юниты предыдущих пачек из БД
+    в той же транзакции, а лог категории, которую меняют несколько пачек, перезаписывается.
+    С defer_unresolved юниты с ещё не пришедшими родителями не проверяются, а возвращаются отложенными.
+    Возвращает id юнитов, чьи поддеревья изменились (юниты запроса и их старые и новые предки), и отложенные юниты
+    """
+    units: dict[str, ShopUnitsDB] = await get_units_with_ancestors(
+        {item.id for item in items} | {item.parentId for item in items if item.parentId is not None}, db)
+    pending: list[ShopUnitImport] = []
+    if defer_unresolved:
+        items, pending = split_resolved(items, units)
+        if not items:
+            return set(), pending
+    validate_import(items, units)
+    loaded_rows: dict[str, dict[str, Any]] = {unit.id: unit_to_row(unit) for unit in units.values()}
+    # Старые родитель и цена уже существующих юнитов, нужны для пересчёта агрегатов категорий
+    old_states: dict[str, tuple[str | None, int | None]] = {
+        item.id: (units[item.id].parent_category, units[item.id].price) for item in items if item.id in units
+    }
+
+    res_list: list[ShopUnitsDB] = [from_pyschema_to_db_schema(item, update_date, units) for item in items]
+    request_ids: set[str] = {unit.id for unit in res_list}
+    units.update({unit.id: unit for unit in res_list})
+    # Агрегаты категорий пересчитываются дельтами вдоль цепочек старых и новых предков
+    update_aggregates(res_list, old_states, units)
+    moves: list[tuple[str, str]] = update_paths(units)
+
+    logs: list[dict[str, Any]] = []
+    categories: set[str] = set()  # Категории запроса и обновлённые предки товаров, по одному логу на категорию
+    for unit in res_list:
+        if unit.type == ShopUnitType.category:
+            categories.add(unit.id)
+            continue
+        logs.append(make_update_log(unit, import_id))
+        categories.update(parent.id for parent in update_parents(unit.parent_category, update_date, units))
+    logs += [make_update_log(units[unit_id], import_id) for unit_id in categories]
+
+    await move_subtrees(moves, db)
+    await save_units(res_list, db)
+    await update_units([unit for unit in units.values()
+                        if unit.id not in request_ids and unit_to_row(unit) != loaded_rows[unit.id]], db)
+    await save_logs(logs, db)
+    return set(units.keys()), pending
+
+
+async def create_stream_ids_table(db: AsyncSession) -> None:
+    """Временная таблица id потокового импорта для поиска повторов, удаляется при комите или откате транзакции"""
+    await db.execute(text(f"CREATE TEMP TABLE {STREAM_IDS_TABLE} (id VARCHAR PRIMARY KEY) ON COMMIT DROP"))
 
 
-def add_and_refresh_db(inst: ShopUnitsDB, db: Session) -> None:
+async def find_repeated_id(ids: list[str], db: AsyncSession) -> str | None:
     """
-    Сервисная функция для отправки элемента в БД и комита, может использоваться
-    как для обновления, так и для добавления
+    Записывает id пачки потокового импорта во временную таблицу и возвращает первый id пачки, который уже
+    встречался раньше в потоке или в самой пачке, так что id всего потока не держатся в памяти
     """
-    db.add(inst)
-    db.commit()
-    db.refresh(inst)
-    return
+    if not ids:
+        return None
+    statement = text(f"INSERT INTO {STREAM_IDS_TABLE} SELECT unnest(CAST(:ids AS VARCHAR[])) "
+                     "ON CONFLICT DO NOTHING RETURNING id").bindparams(bindparam("ids", type_=ARRAY(String)))
+    inserted: set[str] = set((await db.execute(statement, {"ids": ids})).scalars())
+    seen: set[str] = set()
+    for unit_id in ids:
+        if unit_id not in inserted or unit_id in seen:
+            return unit_id
+        seen.add(unit_id)
+    return None
@@ -0,0 +1,81 @@
+from db.schema import ShopUnitsDB
+from .exceptions import InvalidImport
+from .schema import ShopUnitImport, ShopUnitType
+
+
+def validate_import(items: list[ShopUnitImport], units: dict[str, ShopUnitsDB]) -> None:
+    """
+    Валидация всего импорта за один проход по запросу и заранее загруженным из БД юнитам
+    (юниты запроса, их родители и все предки, см. get_units_with_ancestors), к БД функция не обращается.
+    Бросает InvalidImport с первой ошибкой в том же порядке, в каком их находил поштучный разбор:
+    повторы id, затем по каждому юниту смена типа, родитель и цена, затем циклы в иерархии
+    """
+    request: dict[str, ShopUnitImport] = validate_unique_ids(items)
+    for item in items:
+        validate_unit(item, request, units)
+    validate_hierarchy(request, units)
+
+
+def validate_unique_ids(items: list[ShopUnitImport]) -> dict[str, ShopUnitImport]:
+    """Проверка повторов id в запросе, возвращает юниты запроса по id"""
+    request: dict[str, ShopUnitImport] = {}
+    for item in items:
+        if item.id in request:
+            raise InvalidImport(message=f"Данный id={item.id} встретился больше одного раза.")
+        request[item.id] = item
+    return request
+
+
+def validate_request(items: list[ShopUnitImport]) -> dict[str, ShopUnitImport]:
+    """
+    Проверки запроса без обращения к БД: повторы id и цены по типам юнитов.
+    Их проходит запрос, который ставится в очередь, родителей и циклы проверяет воркер
+    """
+    request: dict[str, ShopUnitImport] = validate_unique_ids(items)
+    for item in items:
+        validate_price(item)
+    return request
+
+
+def validate_unit(item: ShopUnitImport, request: dict[str, ShopUnitImport], units: dict[str, ShopUnitsDB]) -> None:
+    """Проверка одного юнита запроса: неизменность типа, существование родителя-категории и цена"""
+    existing: ShopUnitsDB | None = units.get(item.id)
+    if existing is not None and item.type != existing.type:  # Если такой юнит уже сущетсвует то изменять его тип запрещено
+        raise InvalidImport(message=f"При обновлении нельзя менять тип юнита: id={item.id}")
+
+    if item.parentId is not None:
+        # Тип родителя из БД, если он уже существует, иначе из запроса
+        parent: ShopUnitsDB | ShopUnitImport | None = units.get(item.parentId) or request.get(item.parentId)
+        if parent is None or parent.type != ShopUnitType.category:
+            raise InvalidImport(message=f"Такого родителя не существует или он не является категорией: id={item.id}")
+    validate_price(item)
+
+
+def validate_price(item: ShopUnitImport) -> None:
+    """У категорий нет цены, у товаров она есть и неотрицательна"""
+    if item.type == ShopUnitType.category and item.price is not None:
+        raise InvalidImport(message=f"У категорий не должно быть цены: id={item.id}")
+    elif item.type == ShopUnitType.offer and (item.price is None or item.price < 0):
+        raise InvalidImport(message=f"У товаров должна быть цена, и она должна быть больше 0: id={item.id}")
+
+
+def validate_hierarchy(request: dict[str, ShopUnitImport], units: dict[str, ShopUnitsDB]) -> None:
+    """
+    Поиск циклов в иерархии после импорта: родители юнитов запроса берутся из запроса, остальных - из БД.
+    Каждый юнит проходится один раз, цепочка обрывается на первом уже проверенном юните, поэтому O(n)
+    """
+    checked: dict[str, bool] = {}  # False - юнит на текущей цепочке, True - от юнита до корня циклов нет
+    for unit_id in request:
+        chain: list[str] = []
+        current: str | None = unit_id
+        while current is not None and current not in checked:
+            checked[current] = False
+            chain.append(current)
+            if current in request:
+                current = request[current].parentId
+            else:
+                current = units[current].parent_category if current in units else None
+        if current is not None and not checked[current]:  # Цепочка вернулась в саму себя
+            raise InvalidImport(message=f"Обнаружен цикл в иерархии категорий: id={current}")
+        for chain_id in chain:
+            checked[chain_id] = True
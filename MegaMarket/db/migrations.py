@@ -0,0 +1,342 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable
+
+from sqlalchemy import MetaData, Table, inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+from api.service_funcs import CATALOG_LOCK_ID, LOG_TABLE, get_upcoming_months, make_log_partition_sql, \
+    make_default_log_partition_sql
+from db.main import Base
+import db.schema  # noqa: F401, регистрирует модели в Base.metadata
+
+MIGRATIONS_LOCK_ID = 2  # id advisory lock, под которым выполняются миграции, чтоб их не накатывали два процесса сразу
+MIGRATION_BATCH_SIZE = 10000  # Сколько строк заполнять одним запросом в миграциях, заполняющих данные пачками
+
+
+@dataclass(frozen=True)
+class Migration:
+    """
+    Одна версия схемы. Транзакционные миграции применяются вместе с записью о версии в одной транзакции,
+    нетранзакционные (CREATE INDEX CONCURRENTLY, заполнение данных пачками) выполняются в autocommit
+    и должны быть идемпотентны, т.к. при падении процесса между шагами они будут выполнены повторно
+    """
+    version: int
+    name: str
+    apply: Callable[[Connection], None]
+    transactional: bool = True
+
+
+def create_baseline(conn: Connection) -> None:
+    """Создание недостающих таблиц по текущим моделям, существующие таблицы не меняются"""
+    Base.metadata.create_all(bind=conn)
+    if is_partitioned(conn, LOG_TABLE):  # Логи только что созданы по модели уже секционированными
+        conn.execute(text(make_default_log_partition_sql()))
+
+
+def is_partitioned(conn: Connection, table: str) -> bool:
+    return conn.execute(text("SELECT relkind = 'p' FROM pg_class WHERE relname = :table"),
+                        {"table": table}).scalar() or False
+
+
+def add_paths_and_aggregates(conn: Connection) -> None:
+    """
+    Добавление и заполнение path и агрегатов offers_sum/offers_count в базе со старой схемой, в autocommit.
+    Колонки добавляются без перезаписи таблицы, заполнение идёт пачками по MIGRATION_BATCH_SIZE строк,
+    каждая своей короткой транзакцией, поэтому чтение и запись shop_units на время заполнения не блокируются
+    """
+    conn.execute(text("ALTER TABLE shop_units ADD COLUMN IF NOT EXISTS offers_sum BIGINT NOT NULL DEFAULT 0"))
+    conn.execute(text("ALTER TABLE shop_units ADD COLUMN IF NOT EXISTS offers_count INTEGER NOT NULL DEFAULT 0"))
+    conn.execute(text('ALTER TABLE shop_units ADD COLUMN IF NOT EXISTS path VARCHAR COLLATE "C"'))
+    fill_paths(conn)
+    fill_aggregates(conn)
+    # SET NOT NULL не сканирует таблицу под ACCESS EXCLUSIVE, если NOT NULL следует из проверенного CHECK,
+    # а VALIDATE CONSTRAINT проверяет строки, не блокируя чтение и запись
+    if conn.execute(text("SELECT 1 FROM pg_constraint WHERE conname = 'shop_units_path_not_null'")).scalar() is None:
+        conn.execute(text("ALTER TABLE shop_units ADD CONSTRAINT shop_units_path_not_null "
+                          "CHECK (path IS NOT NULL) NOT VALID"))
+    conn.execute(text("ALTER TABLE shop_units VALIDATE CONSTRAINT shop_units_path_not_null"))
+    conn.execute(text("ALTER TABLE shop_units ALTER COLUMN path SET NOT NULL"))
+    conn.execute(text("ALTER TABLE shop_units DROP CONSTRAINT shop_units_path_not_null"))
+
+
+def fill_paths(conn: Connection) -> None:
+    """
+    Заполнение пустых path проходами по id: за проход path получают юниты, у родителя которых он уже есть,
+    поэтому проходов не больше глубины дерева. Юниты с несуществующим родителем считаются корнями
+    """
+    filled: int = 1
+    while filled:
+        filled, after = 0, ""
+        while True:
+            last, count = conn.execute(text("""
+                WITH batch AS (
+                    SELECT u.id, COALESCE(p.path, '') || u.id || '/' AS path
+                    FROM shop_units u LEFT JOIN shop_units p ON p.id = u.parent_category
+                    WHERE u.id > :after AND u.path IS NULL AND (p.id IS NULL OR p.path IS NOT NULL)
+                    ORDER BY u.id LIMIT :limit
+                ), updated AS (
+                    UPDATE shop_units SET path = batch.path FROM batch WHERE shop_units.id = batch.id
+                )
+                SELECT max(id), count(*) FROM batch
+            """), {"after": after, "limit": MIGRATION_BATCH_SIZE}).one()
+            if not count:
+                break
+            filled, after = filled + count, last
+
+
+def fill_aggregates(conn: Connection) -> None:
+    """
+    Пересчёт offers_sum/offers_count категорий за O(товары * глубина): пачка товаров по id раскладывается
+    по предкам из их path, вклады группируются по предку и прибавляются одним UPDATE.
+    Агрегаты сначала обнуляются, чтоб повтор после падения не прибавил вклады дважды
+    """
+    conn.execute(text("""
+        UPDATE shop_units SET offers_sum = 0, offers_count = 0
+        WHERE type = 'category' AND (offers_sum <> 0 OR offers_count <> 0)
+    """))
+    after: str = ""
+    while True:
+        last, count = conn.execute(text("""
+            WITH batch AS (
+                SELECT id, price, path FROM shop_units
+                WHERE id > :after AND type = 'offer'
+                ORDER BY id LIMIT :limit
+            ), contributions AS (
+                SELECT ancestor.id, sum(COALESCE(batch.price, 0)) AS offers_sum, count(*) AS offers_count
+                FROM batch CROSS JOIN LATERAL unnest(string_to_array(rtrim(batch.path, '/'), '/')) AS ancestor(id)
+                WHERE ancestor.id <> batch.id
+                GROUP BY ancestor.id
+            ), updated AS (
+                UPDATE shop_units SET offers_sum = shop_units.offers_sum + contributions.offers_sum,
+                                      offers_count = shop_units.offers_count + contributions.offers_count
+                FROM contributions WHERE shop_units.id = contributions.id
+            )
+            SELECT max(id), count(*) FROM batch
+        """), {"after": after, "limit": MIGRATION_BATCH_SIZE}).one()
+        if not count:
+            break
+        after = last
+
+
+def backfill_imports(conn: Connection) -> None:
+    """
+    Заполнение таблицы imports по старым логам и перевод её последовательности за последний id,
+    удаление дублей логов, которые не даст создать уникальный индекс (unit_id, import_request_id)
+    """
+    conn.execute(text("""
+        DELETE FROM shop_units_update_logs a USING shop_units_update_logs b
+        WHERE a.unit_id = b.unit_id AND a.import_request_id = b.import_request_id AND a.id > b.id
+    """))
+    # Сколько юнитов было в самом запросе старые логи не хранят, поэтому считаем все залогированные юниты
+    conn.execute(text("""
+        INSERT INTO imports (id, update_date, items_count)
+        SELECT import_request_id, max(update_date) AT TIME ZONE 'UTC', count(*)
+        FROM shop_units_update_logs GROUP BY import_request_id
+        ON CONFLICT (id) DO NOTHING
+    """))
+    conn.execute(text("""
+        SELECT setval(pg_get_serial_sequence('imports', 'id'), COALESCE((SELECT max(id) FROM imports), 0) + 1, false)
+    """))
+
+
+def add_import_job_attempts(conn: Connection) -> None:
+    """Счётчик попыток задач импорта, колонка с константным DEFAULT добавляется без перезаписи таблицы"""
+    conn.execute(text("ALTER TABLE import_jobs ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0"))
+
+
+def partition_update_logs(conn: Connection) -> None:
+    """
+    Перевод shop_units_update_logs в таблицу, секционированную по месяцам update_date, в autocommit без остановки
+    записи логов. Рядом создаётся секционированная shop_units_update_logs_new с той же последовательностью id,
+    триггер на старой таблице повторяет в ней все изменения логов, а старые логи копируются пачками.
+    В конце таблицы меняются местами короткой транзакцией под блокировкой каталога
+    """
+    if is_partitioned(conn, LOG_TABLE):
+        return
+    new_name: str = f"{LOG_TABLE}_new"
+    indexes: list[str] = conn.execute(text("""
+        SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = 'shop_units_update_logs'::regclass AND NOT c.relname LIKE '%\\_old'
+    """)).scalars().all()
+    for index in indexes:  # Имена индексов уникальны в схеме, новая таблица создаёт индексы с теми же именами
+        conn.execute(text(f'ALTER INDEX "{index}" RENAME TO "{index}_old"'))
+    metadata = MetaData()
+    Base.metadata.tables["shop_units"].to_metadata(metadata)  # Цель внешнего ключа логов
+    new_table: Table = Base.metadata.tables[LOG_TABLE].to_metadata(metadata, name=new_name)
+    new_table.create(bind=conn, checkfirst=True)
+    conn.execute(text(f"ALTER TABLE {new_name} ALTER COLUMN id SET DEFAULT nextval('{LOG_TABLE}_id_seq')"))
+    conn.execute(text(f"DROP SEQUENCE IF EXISTS {new_name}_id_seq"))
+    months: set[datetime] = get_upcoming_months(datetime.utcnow(), 1)
+    months.update(conn.execute(text(f"SELECT DISTINCT date_trunc('month', update_date) FROM {LOG_TABLE}")).scalars())
+    for month in months:
+        conn.execute(text(make_log_partition_sql(month, new_name)))
+    conn.execute(text(make_default_log_partition_sql(new_name)))
+
+    columns: list[str] = [column.name for column in new_table.columns]
+    conn.execute(text(f"""
+        CREATE OR REPLACE FUNCTION {LOG_TABLE}_mirror() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP <> 'INSERT' THEN
+                DELETE FROM {new_name} WHERE id = OLD.id;
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                INSERT INTO {new_name} ({", ".join(columns)}) VALUES ({", ".join(f"NEW.{c}" for c in columns)})
+                ON CONFLICT DO NOTHING;
+            END IF;
+            RETURN NULL;
+        END
+        $$
+    """))
+    # CREATE TRIGGER ждёт идущие записи в логи, поэтому каждый лог, закомиченный после него, попадёт в новую таблицу
+    # триггером, а закомиченный раньше - копированием ниже
+    if conn.execute(text(f"SELECT 1 FROM pg_trigger WHERE tgname = '{LOG_TABLE}_mirror'")).scalar() is None:
+        conn.execute(text(f"CREATE TRIGGER {LOG_TABLE}_mirror AFTER INSERT OR UPDATE OR DELETE ON {LOG_TABLE} "
+                          f"FOR EACH ROW EXECUTE FUNCTION {LOG_TABLE}_mirror()"))
+    after: int = 0
+    while True:
+        # FOR SHARE не даёт удалить или изменить лог до комита пачки, иначе триггер не нашёл бы копию
+        # и в новой таблице осталась бы устаревшая строка
+        last, count = conn.execute(text(f"""
+            WITH batch AS (
+                SELECT {", ".join(columns)} FROM {LOG_TABLE} WHERE id > :after ORDER BY id LIMIT :limit FOR SHARE
+            ), copied AS (
+                INSERT INTO {new_name} ({", ".join(columns)}) SELECT {", ".join(columns)} FROM batch
+                ON CONFLICT DO NOTHING
+            )
+            SELECT max(id), count(*) FROM batch
+        """), {"after": after, "limit": MIGRATION_BATCH_SIZE}).one()
+        if not count:
+            break
+        after = last
+
+    # Блокировка каталога первой, как в импортах, иначе импорт, уже пишущий логи, и замена ждали бы друг друга
+    with conn.engine.begin() as swap:
+        swap.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": CATALOG_LOCK_ID})
+        swap.execute(text(f"LOCK TABLE {LOG_TABLE} IN ACCESS EXCLUSIVE MODE"))
+        swap.execute(text(f"ALTER SEQUENCE {LOG_TABLE}_id_seq OWNED BY {new_name}.id"))
+        swap.execute(text(f"DROP TABLE {LOG_TABLE}"))  # Вместе с триггером
+        swap.execute(text(f"DROP FUNCTION {LOG_TABLE}_mirror()"))
+        swap.execute(text(f"ALTER TABLE {new_name} RENAME TO {LOG_TABLE}"))
+        swap.execute(text(f"ALTER TABLE {LOG_TABLE} RENAME CONSTRAINT {new_name}_pkey TO {LOG_TABLE}_pkey"))
+        swap.execute(text(f"ALTER TABLE {LOG_TABLE} RENAME CONSTRAINT {new_name}_unit_id_fkey "
+                          f"TO {LOG_TABLE}_unit_id_fkey"))
+
+
+def create_index_concurrently(name: str, table: str, columns: str, unique: bool = False,
+                              where: str | None = None) -> Callable[[Connection], None]:
+    """
+    Создание индекса без блокировки записи в таблицу. Невалидный индекс, оставшийся от упавшей
+    предыдущей попытки, удаляется, иначе IF NOT EXISTS посчитал бы его уже созданным
+    """
+    def apply(conn: Connection) -> None:
+        invalid: bool = conn.execute(text("""
+            SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = :name
+        """), {"name": name}).scalar() or False
+        if invalid:
+            conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+        conn.execute(text(f'CREATE {"UNIQUE " if unique else ""}INDEX CONCURRENTLY IF NOT EXISTS "{name}" '
+                          f'ON {table} ({columns})' + (f' WHERE {where}' if where is not None else '')))
+    return apply
+
+
+def drop_index_concurrently(name: str) -> Callable[[Connection], None]:
+    """Удаление индекса без блокировки записи в таблицу"""
+    def apply(conn: Connection) -> None:
+        conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+    return apply
+
+
+# Все миграции по порядку, уже применённые версии не меняются, изменения схемы добавляются новыми версиями
+MIGRATIONS: list[Migration] = [
+    Migration(1, "baseline", create_baseline),
+    Migration(2, "shop_units paths and aggregates", add_paths_and_aggregates, transactional=False),
+    Migration(3, "imports backfill", backfill_imports),
+    Migration(4, "shop_units path index",
+              create_index_concurrently("ix_shop_units_path", "shop_units", "path"), transactional=False),
+    Migration(5, "shop_units parent_category index",
+              create_index_concurrently("ix_shop_units_parent_category", "shop_units", "parent_category"),
+              transactional=False),
+    Migration(6, "shop_units type, last_update index",
+              create_index_concurrently("ix_shop_units_type_last_update", "shop_units", "type, last_update"),
+              transactional=False),
+    Migration(7, "update logs unit_id, update_date index",
+              create_index_concurrently("ix_shop_units_update_logs_unit_id_update_date",
+                                        "shop_units_update_logs", "unit_id, update_date"),
+              transactional=False),
+    Migration(8, "update logs unique unit_id, import_request_id index",
+              create_index_concurrently("uq_shop_units_update_logs_unit_id_import_request_id",
+                                        "shop_units_update_logs", "unit_id, import_request_id", unique=True),
+              transactional=False),
+    Migration(9, "shop_units parent_category, id index",
+              create_index_concurrently("ix_shop_units_parent_category_id", "shop_units", "parent_category, id"),
+              transactional=False),
+    Migration(10, "drop shop_units parent_category index",
+              drop_index_concurrently("ix_shop_units_parent_category"), transactional=False),
+    Migration(11, "shop_units offers last_update, id partial index",
+              create_index_concurrently("ix_shop_units_offers_last_update_id", "shop_units", "last_update, id",
+                                        where="type = 'offer'"),
+              transactional=False),
+    Migration(12, "drop shop_units type, last_update index",
+              drop_index_concurrently("ix_shop_units_type_last_update"), transactional=False),
+    Migration(13, "update logs unit_id, update_date, id index",
+              create_index_concurrently("ix_shop_units_update_logs_unit_id_update_date_id",
+                                        "shop_units_update_logs", "unit_id, update_date, id"),
+              transactional=False),
+    Migration(14, "drop update logs unit_id, update_date index",
+              drop_index_concurrently("ix_shop_units_update_logs_unit_id_update_date"), transactional=False),
+    Migration(15, "import jobs table", create_baseline),
+    Migration(16, "partition update logs by month", partition_update_logs, transactional=False),
+    Migration(17, "update log rollups table", create_baseline),
+    Migration(18, "import jobs attempts", add_import_job_attempts),
+]
+
+
+def run_migrations(engine: Engine) -> list[int]:
+    """
+    Функция применяет к БД все ещё не применённые миграции и возвращает их версии.
+    Применённые версии хранятся в таблице schema_migrations, параллельный запуск нескольких
+    процессов сериализуется advisory lock на отдельном соединении.
+    Пустая БД создаётся baseline сразу в текущей схеме моделей, остальные версии для неё только
+    записываются как применённые: часть из них рассчитана на старую схему (индексы CONCURRENTLY
+    на несекционированной таблице логов)
+    """
+    applied_now: list[int] = []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_conn:
+        lock_conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATIONS_LOCK_ID})
+        try:
+            lock_conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name VARCHAR NOT NULL,
+                    applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+                )
+            """))
+            applied: set[int] = set(lock_conn.execute(text("SELECT version FROM schema_migrations")).scalars())
+            fresh: bool = not applied and not inspect(lock_conn).has_table("shop_units")
+            for migration in MIGRATIONS:
+                if migration.version in applied:
+                    continue
+                if fresh and migration is not MIGRATIONS[0]:
+                    with engine.begin() as conn:
+                        save_migration(migration, conn)
+                    continue
+                if migration.transactional:
+                    with engine.begin() as conn:
+                        migration.apply(conn)
+                        save_migration(migration, conn)
+                else:
+                    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                        migration.apply(conn)
+                        save_migration(migration, conn)
+                applied_now.append(migration.version)
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATIONS_LOCK_ID})
+    return applied_now
+
+
+def save_migration(migration: Migration, conn: Connection) -> None:
+    """Запись версии в schema_migrations"""
+    conn.execute(text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                 {"version": migration.version, "name": migration.name})
@@ -1,12 +1,20 @@
-from sqlalchemy import Column, Integer, String, DateTime, Enum as PgEnum, ForeignKey
+from sqlalchemy import text, Column, Integer, BigInteger, Float, String, DateTime, Enum as PgEnum, ForeignKey, Index, func
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 
-from api.schema import ShopUnitType
-from main import Base
+from api.schema import ShopUnitType, ImportJobStatus
+from db.main import Base
 
 
 class ShopUnitsDB(Base):
     __tablename__ = "shop_units"
+    # Индексы, которые в существующие БД добавляют миграции из db/migrations.py, имена должны совпадать
+    __table_args__ = (
+        # Только товары по времени обновления, для окна /sales и постраничной выдачи по (last_update, id)
+        Index("ix_shop_units_offers_last_update_id", "last_update", "id", postgresql_where=text("type = 'offer'")),
+        # Дети категории по порядку id, для постраничной выдачи children в /nodes
+        Index("ix_shop_units_parent_category_id", "parent_category", "id"),
+    )
 
     id = Column(String, primary_key=True)
     type = Column(PgEnum(ShopUnitType, name="type"), nullable=False)
@@ -14,21 +22,94 @@ class ShopUnitsDB(Base):
     price = Column(Integer, nullable=True)
     last_update = Column(DateTime(timezone=True))
     parent_category = Column(String, nullable=True)
+    # Материализованный путь "id_корня/.../id_юнита/", с побайтовой сортировкой (COLLATE "C"),
+    # чтоб поддерево было одним диапазоном индекса, а ORDER BY path давал обход дерева в глубину
+    path = Column(String(collation="C"), nullable=False, index=True)
+    # Агрегаты по всем товарам поддерева категории, у товаров всегда 0
+    offers_sum = Column(BigInteger, nullable=False, default=0, server_default="0")
+    offers_count = Column(Integer, nullable=False, default=0, server_default="0")
 
     update = relationship("ShopUnitUpdatesDB", back_populates="unit")
 
 
 class ShopUnitUpdatesDB(Base):
+    """
+    Логи обновлений юнитов, секционированы по месяцам update_date (см. create_log_partition).
+    Уникальные ключи секционированной таблицы обязаны включать update_date,
+    у всех логов одного импорта она одинаковая
+    """
     __tablename__ = "shop_units_update_logs"
+    __table_args__ = (
+        # История юнита по времени, для постраничной выдачи статистики по (update_date, id)
+        Index("ix_shop_units_update_logs_unit_id_update_date_id", "unit_id", "update_date", "id"),
+        Index("uq_shop_units_update_logs_unit_id_import_request_id", "unit_id", "import_request_id", "update_date",
+              unique=True),
+        {"postgresql_partition_by": "RANGE (update_date)"},
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     unit_id = Column(String, ForeignKey("shop_units.id"), nullable=False)
     name = Column(String, nullable=False)
     price = Column(Integer, nullable=True)
     parent_category = Column(String, nullable=True)
-    update_date = Column(DateTime, nullable=False)
+    update_date = Column(DateTime, primary_key=True)
     import_request_id = Column(Integer, nullable=False)
 
     unit = relationship("ShopUnitsDB", back_populates="update")
 
 
+class ShopUnitRollupsDB(Base):
+    """
+    Свёрнутые старые логи обновлений: по строке на юнит и интервал (час/день/неделя, см. LogsSettings),
+    с агрегатами цены и последним состоянием юнита в интервале. Время, как и в логах, без таймзоны в UTC
+    """
+    __tablename__ = "shop_units_update_rollups"
+    __table_args__ = (
+        Index("uq_shop_units_update_rollups_unit_id_bucket_start", "unit_id", "bucket_start", unique=True),
+        # Свёрнутая история юнита по времени последнего обновления, для статистики вместе с логами
+        Index("ix_shop_units_update_rollups_unit_id_last_update_date_id", "unit_id", "last_update_date", "id"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    unit_id = Column(String, ForeignKey("shop_units.id"), nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    min_price = Column(Integer, nullable=True)
+    max_price = Column(Integer, nullable=True)
+    price_sum = Column(BigInteger, nullable=False)  # Сумма и количество непустых цен, для средней
+    price_count = Column(Integer, nullable=False)
+    updates_count = Column(Integer, nullable=False)
+    last_name = Column(String, nullable=False)
+    last_parent_category = Column(String, nullable=True)
+    last_price = Column(Integer, nullable=True)
+    last_update_date = Column(DateTime, nullable=False)
+
+
+class ImportsDB(Base):
+    """Журнал импортов, id выдаётся последовательностью БД и используется как import_request_id в логах"""
+    __tablename__ = "imports"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    update_date = Column(DateTime(timezone=True), nullable=False)
+    items_count = Column(Integer, nullable=False)
+    processing_time = Column(Float, nullable=True)  # Время обработки импорта в секундах
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+class ImportJobsDB(Base):
+    """Очередь асинхронных импортов, воркер применяет задачи строго по порядку id"""
+    __tablename__ = "import_jobs"
+    __table_args__ = (
+        # Только невыполненные задачи, для выбора следующей задачи воркером
+        Index("ix_import_jobs_pending_id", "id", postgresql_where=text("status IN ('queued', 'running')")),
+    )
+    __mapper_args__ = {"eager_defaults": True}  # created_at возвращается из INSERT, без отдельного запроса
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    status = Column(PgEnum(ImportJobStatus, name="import_job_status"), nullable=False)
+    payload = Column(JSONB, nullable=False)  # Тело запроса /imports
+    import_id = Column(Integer, nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    attempts = Column(Integer, nullable=False, server_default=text("0"))  # Сколько раз воркер брался за задачу
+    finished_at = Column(DateTime(timezone=True), nullable=True)
@@ -0,0 +1,47 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+# Продакшн запуск из каталога MegaMarket: gunicorn main:app
+bind = os.environ.get("BIND", "0.0.0.0:80")
+# По асинхронному воркеру на ядро, число можно переопределить через WEB_CONCURRENCY, но не больше MAX_WORKERS:
+# асинхронный воркер и так держит много запросов, а каждый следующий съедает соединения к БД.
+# Число воркеров задаётся здесь, а не ключом -w: от него считается пул соединений ниже
+workers = min(int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count())),
+              int(os.environ.get("MAX_WORKERS", 8)))
+
+# Соединения к БД всех воркеров укладываются в DB_CONNECTION_BUDGET. У Postgres по умолчанию max_connections=100,
+# из них 3 зарезервированы под суперпользователя, бюджет 80 оставляет запас под psql, бэкапы и т.п.
+# Каждый воркер держит одно LISTEN соединение инвалидаций кэша (run_cache_listener) и пул
+# из DB_POOL_SIZE + DB_MAX_OVERFLOW соединений, из него же берут соединения очередь импортов и свёртка логов:
+#     workers * (1 + DB_POOL_SIZE + DB_MAX_OVERFLOW) <= DB_CONNECTION_BUDGET
+# Пул делится как треть постоянных соединений и остальное сверх них под нагрузкой,
+# например 8 воркеров: 80 // 8 - 1 = 9 соединений пула, pool_size 3 и max_overflow 6.
+# Соединения миграций открываются в мастере до форка и закрываются до старта воркеров.
+# Явно заданные DB_POOL_SIZE и DB_MAX_OVERFLOW не переопределяются, за бюджетом тогда следит тот, кто их задал
+connection_budget = int(os.environ.get("DB_CONNECTION_BUDGET", 80))
+pool_connections = max(connection_budget // workers - 1, 1)
+os.environ.setdefault("DB_POOL_SIZE", str(max(pool_connections // 3, 1)))
+os.environ.setdefault("DB_MAX_OVERFLOW", str(max(pool_connections - int(os.environ["DB_POOL_SIZE"]), 0)))
+# Uvicorn воркер без reload, с uvicorn[standard] он работает на uvloop и httptools
+worker_class = "uvicorn.workers.UvicornWorker"
+# Приложение импортируется один раз в мастере до форка, вместе с ним один раз применяются миграции
+preload_app = True
+# Сколько секунд при остановке ждать текущие запросы и задачу очереди импортов,
+# должно быть больше IMPORT_JOBS_SHUTDOWN_TIMEOUT
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 60))
+keepalive = 5
+accesslog = "-"
+
+# Воркеры пишут метрики в файлы этого каталога, /metrics в любом воркере отдаёт их сумму (см. api/metrics.py).
+# Каталог задаётся до загрузки приложения и очищается при каждом запуске, чтоб не суммировать прошлые запуски
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "megamarket_metrics"))
+shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+
+def child_exit(server, worker):
+    """Накопленные метрики завершившегося воркера остаются в сумме, его файлы живых значений удаляются"""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,10 +1,15 @@
+import asyncio
+
 from fastapi import FastAPI
 from fastapi.exceptions import RequestValidationError
 from fastapi.openapi.utils import get_openapi
 from fastapi.responses import JSONResponse
 
-from db.main import Base, engine
+from db.main import engine
+from api.jobs import run_import_worker, stop_import_worker, run_logs_maintenance, run_cache_listener
+from api.middleware import metrics_middleware
 from api.routes import routes
+from db.migrations import run_migrations
 
 tags_metadata = [
     {
@@ -15,11 +20,41 @@ tags_metadata = [
         "name": "additional tasks",
         "description": "Information about updates",
     },
+    {
+        "name": "service",
+        "description": "Service information about the running worker",
+    },
 ]
 
-Base.metadata.create_all(bind=engine)  # Создание всех таблиц, если таблица уже существует, она не обновится, нужен drop
+# Накатывание на БД всех ещё не применённых миграций схемы из db/migrations.py. Под gunicorn с preload_app
+# модуль импортируется один раз в мастере, поэтому миграции идут до форка воркеров, а не в каждом из них
+run_migrations(engine)
+engine.dispose()  # Соединения миграций не должны достаться форкнутым воркерам
 app = FastAPI(openapi_tags=tags_metadata)  # Инициализация приложения
 app.include_router(routes)
+app.middleware("http")(metrics_middleware)
+
+
+@app.on_event("startup")
+async def start_workers():
+    """
+    Запуск фоновых воркеров в каждом процессе: очереди асинхронных импортов, инвалидаций кэша от других процессов
+    и обслуживания логов
+    """
+    app.state.import_worker = asyncio.create_task(run_import_worker())
+    app.state.cache_listener = asyncio.create_task(run_cache_listener())
+    app.state.logs_maintenance = asyncio.create_task(run_logs_maintenance())
+
+
+@app.on_event("shutdown")
+async def stop_workers():
+    """
+    Остановка воркеров. Вызывается после того, как сервер дождался текущих запросов, в т.ч. импортов;
+    воркер очереди дорабатывает текущую задачу, прерванная по таймауту задача откатится и будет выполнена заново
+    """
+    await stop_import_worker(app.state.import_worker)
+    app.state.cache_listener.cancel()
+    app.state.logs_maintenance.cancel()
 
 
 @app.exception_handler(RequestValidationError)
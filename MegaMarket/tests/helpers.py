@@ -0,0 +1,52 @@
+from datetime import datetime
+
+from api.schema import ShopUnitImport, ShopUnitType
+from api.service_funcs import PATH_SEPARATOR, from_pyschema_to_db_schema, update_aggregates, update_paths
+from api.validation import validate_import
+from db.schema import ShopUnitsDB
+
+DATE = datetime(2022, 2, 1, 12)
+
+
+def make_id(name: str) -> str:
+    """Валидный id юнита из имени до 4 символов, чтоб в тестах было видно, какой юнит где"""
+    return f"{name.encode().hex():0>8}-0000-0000-0000-000000000000"
+
+
+def make_path(*names: str) -> str:
+    return "".join(make_id(name) + PATH_SEPARATOR for name in names)
+
+
+def make_item(name: str, parent: str | None, unit_type: ShopUnitType, price: int | None = None) -> ShopUnitImport:
+    return ShopUnitImport(id=make_id(name), name=name, parentId=make_id(parent) if parent else None,
+                          type=unit_type, price=price)
+
+
+def make_unit(name: str, parent: ShopUnitsDB | None, unit_type: ShopUnitType, price: int | None = None,
+              offers_sum: int = 0, offers_count: int = 0) -> ShopUnitsDB:
+    """Юнит, как он лежит в БД: path от родителя, агрегаты категорий задаются явно"""
+    return ShopUnitsDB(id=make_id(name), name=name, type=unit_type, price=price, last_update=DATE,
+                       parent_category=parent.id if parent else None,
+                       path=(parent.path if parent else "") + make_id(name) + PATH_SEPARATOR,
+                       offers_sum=offers_sum, offers_count=offers_count)
+
+
+def make_tree() -> dict[str, ShopUnitsDB]:
+    """root -> a -> b -> c, b -> o1 (100), a -> o2 (50), агрегаты категорий посчитаны"""
+    root = make_unit("root", None, ShopUnitType.category, offers_sum=150, offers_count=2)
+    a = make_unit("a", root, ShopUnitType.category, offers_sum=150, offers_count=2)
+    b = make_unit("b", a, ShopUnitType.category, offers_sum=100, offers_count=1)
+    c = make_unit("c", b, ShopUnitType.category)
+    o1 = make_unit("o1", b, ShopUnitType.offer, price=100)
+    o2 = make_unit("o2", a, ShopUnitType.offer, price=50)
+    return {unit.id: unit for unit in (root, a, b, c, o1, o2)}
+
+
+def apply_import(items: list[ShopUnitImport], units: dict[str, ShopUnitsDB]) -> list[tuple[str, str]]:
+    """Пересчёт импорта в памяти, как в import_batch: агрегаты, затем пути; возвращает переносы поддеревьев"""
+    validate_import(items, units)
+    old_states = {item.id: (units[item.id].parent_category, units[item.id].price) for item in items if item.id in units}
+    res_list = [from_pyschema_to_db_schema(item, DATE, units) for item in items]
+    units.update({unit.id: unit for unit in res_list})
+    update_aggregates(res_list, old_states, units)
+    return update_paths(units)
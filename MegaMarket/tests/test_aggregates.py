@@ -0,0 +1,47 @@
+from api.schema import ShopUnitType
+from api.service_funcs import get_category_price
+from tests.helpers import make_item, make_id, make_tree, apply_import
+
+
+def get_aggregates(units, name):
+    unit = units[make_id(name)]
+    return unit.offers_sum, unit.offers_count
+
+
+def test_price_change():
+    units = make_tree()
+    apply_import([make_item("o1", "b", ShopUnitType.offer, 130)], units)
+    assert [get_aggregates(units, name) for name in ("root", "a", "b", "c")] == [(180, 2), (180, 2), (130, 1), (0, 0)]
+    assert get_category_price(units[make_id("a")]) == 90
+
+
+def test_move_child_out_of_moved_parent():
+    # a уходит в корень, b, лежавший под a, - под root, у o1 меняется цена
+    units = make_tree()
+    apply_import([make_item("a", None, ShopUnitType.category),
+                  make_item("b", "root", ShopUnitType.category),
+                  make_item("o1", "b", ShopUnitType.offer, 300)], units)
+    assert get_aggregates(units, "root") == (300, 1)
+    assert get_aggregates(units, "a") == (50, 1)
+    assert get_aggregates(units, "b") == (300, 1)
+
+
+def test_move_parent_under_former_child():
+    # b поднимается в корень, a уходит под b вместе с o2, root пустеет
+    units = make_tree()
+    apply_import([make_item("b", None, ShopUnitType.category),
+                  make_item("a", "b", ShopUnitType.category)], units)
+    assert get_aggregates(units, "root") == (0, 0)
+    assert get_category_price(units[make_id("root")]) is None
+    assert get_aggregates(units, "b") == (150, 2)
+    assert get_aggregates(units, "a") == (50, 1)
+
+
+def test_new_units_under_moved_category():
+    units = make_tree()
+    apply_import([make_item("a", None, ShopUnitType.category),
+                  make_item("d", "a", ShopUnitType.category),
+                  make_item("o3", "d", ShopUnitType.offer, 10)], units)
+    assert get_aggregates(units, "root") == (0, 0)
+    assert get_aggregates(units, "a") == (160, 3)
+    assert get_aggregates(units, "d") == (10, 1)
@@ -0,0 +1,36 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from api.service_funcs import encode_cursor, decode_cursor
+from tests.helpers import DATE, make_id
+
+
+def test_round_trip():
+    date = datetime(2022, 2, 1, 12, tzinfo=timezone.utc)
+    assert decode_cursor(encode_cursor(date, "id"), datetime, str) == (date, "id")
+    # Даты логов без пояса записываются как UTC
+    assert decode_cursor(encode_cursor(date.replace(tzinfo=None), 7), datetime, int) == (date, 7)
+    assert decode_cursor(encode_cursor(make_id("a")), str) == (make_id("a"),)
+
+
+@pytest.mark.parametrize("cursor", [
+    "not-a-cursor",
+    "",
+    encode_cursor(DATE, "id")[:-4],
+    "WzEsMl0=",  # [1,2]: дата не строка
+    "eyJhIjoxfQ==",  # {"a":1}: не список
+    "WyIyMDIyLTAyLTAxIl0=",  # ["2022-02-01"]: нет id
+    "WyIyMDIyLTAyLTAxVDEyOjAwOjAwIiwiaWQiXQ==",  # ["2022-02-01T12:00:00","id"]: дата без пояса
+    encode_cursor(DATE, 7),  # Курсор /statistic в /sales
+    encode_cursor(make_id("a")),  # Курсор /nodes в /sales
+])
+def test_bad_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, datetime, str)
+
+
+@pytest.mark.parametrize("cursor", [make_id("a"), encode_cursor(DATE, "id"), encode_cursor(7)])
+def test_bad_nodes_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, str)
@@ -0,0 +1,52 @@
+import asyncio
+
+import orjson
+import pytest
+
+from api.schema import ShopUnitType
+from api.service_funcs import encode_subtree
+from tests.helpers import make_unit, make_id, make_tree
+
+
+class FakeResult:
+    """Курсор поддерева, отдающий оставшиеся строки кусками заданного размера"""
+
+    def __init__(self, rows, size):
+        self.rows, self.size = rows, size
+
+    async def fetchmany(self, size):
+        chunk, self.rows = self.rows[:self.size], self.rows[self.size:]
+        return chunk
+
+
+def encode(rows, size):
+    async def collect():
+        return b"".join([chunk async for chunk in encode_subtree(rows[:size], FakeResult(rows[size:], size))])
+    return orjson.loads(asyncio.run(collect()))
+
+
+def get_shape(node):
+    """Дерево ответа в виде (id, цена, потомки), без дат и имён"""
+    children = node["children"]
+    return node["id"], node["price"], None if children is None else [get_shape(child) for child in children]
+
+
+@pytest.mark.parametrize("size", [1, 2, 100])
+def test_encode_subtree(size):
+    rows = sorted(make_tree().values(), key=lambda unit: unit.path)
+    assert get_shape(encode(rows, size)) == (
+        make_id("root"), 75, [
+            (make_id("a"), 75, [
+                (make_id("b"), 100, [(make_id("c"), None, []), (make_id("o1"), 100, None)]),
+                (make_id("o2"), 50, None)
+            ])
+        ]
+    )
+
+
+def test_encode_offer_and_empty_category():
+    offer = make_unit("o1", None, ShopUnitType.offer, price=10)
+    assert encode([offer], 1) == {"id": offer.id, "name": "o1", "date": "2022-02-01T12:00:00.000Z",
+                                  "parentId": None, "type": "OFFER", "price": 10, "children": None}
+    category = make_unit("c", None, ShopUnitType.category)
+    assert get_shape(encode([category], 1)) == (category.id, None, [])
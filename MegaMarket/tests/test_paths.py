@@ -0,0 +1,44 @@
+from api.schema import ShopUnitType
+from api.service_funcs import get_path_ids
+from tests.helpers import make_item, make_id, make_path, make_tree, apply_import
+
+
+def get_paths(units, *names):
+    return [units[make_id(name)].path for name in names]
+
+
+def test_move_child_out_of_moved_parent():
+    # a уходит в корень, b, лежавший под a, - под root
+    units = make_tree()
+    moves = apply_import([make_item("a", None, ShopUnitType.category),
+                          make_item("b", "root", ShopUnitType.category)], units)
+    assert get_paths(units, "a", "b", "c", "o1", "o2") == [
+        make_path("a"), make_path("root", "b"), make_path("root", "b", "c"),
+        make_path("root", "b", "o1"), make_path("a", "o2")
+    ]
+    # Сначала более глубокая b, иначе перенос a переписал бы её старый путь
+    assert moves == [(make_path("root", "a", "b"), make_path("root", "b")), (make_path("root", "a"), make_path("a"))]
+
+
+def test_move_parent_under_former_child():
+    units = make_tree()
+    moves = apply_import([make_item("b", None, ShopUnitType.category),
+                          make_item("a", "b", ShopUnitType.category)], units)
+    assert get_paths(units, "root", "b", "a", "c", "o2") == [
+        make_path("root"), make_path("b"), make_path("b", "a"), make_path("b", "c"), make_path("b", "a", "o2")
+    ]
+    assert moves == [(make_path("root", "a", "b"), make_path("b")), (make_path("root", "a"), make_path("b", "a"))]
+
+
+def test_new_units_and_offer_moves():
+    # Перенос товара не переносит поддерево, новые юниты получают путь от нового родителя
+    units = make_tree()
+    moves = apply_import([make_item("d", "c", ShopUnitType.category),
+                          make_item("o1", "d", ShopUnitType.offer, 100)], units)
+    assert get_paths(units, "d", "o1") == [make_path("root", "a", "b", "c", "d"),
+                                           make_path("root", "a", "b", "c", "d", "o1")]
+    assert moves == []
+
+
+def test_get_path_ids():
+    assert get_path_ids(make_path("root", "a")) == [make_id("root"), make_id("a")]
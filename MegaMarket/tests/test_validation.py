@@ -0,0 +1,40 @@
+import pytest
+
+from api.exceptions import InvalidImport
+from api.schema import ShopUnitType
+from api.validation import validate_import
+from tests.helpers import make_item, make_id, make_tree
+
+
+def test_cycle_within_request():
+    items = [make_item("x", "y", ShopUnitType.category), make_item("y", "x", ShopUnitType.category)]
+    with pytest.raises(InvalidImport, match="цикл"):
+        validate_import(items, {})
+
+
+def test_cycle_through_db():
+    # a уходит под новую категорию из запроса, а та - под c, который в БД лежит под a
+    items = [make_item("a", "new", ShopUnitType.category), make_item("new", "c", ShopUnitType.category)]
+    with pytest.raises(InvalidImport, match="цикл"):
+        validate_import(items, make_tree())
+
+
+def test_move_under_own_descendant():
+    with pytest.raises(InvalidImport, match=f"цикл.*id={make_id('a')}"):
+        validate_import([make_item("a", "c", ShopUnitType.category)], make_tree())
+
+
+def test_move_under_itself():
+    with pytest.raises(InvalidImport, match="цикл"):
+        validate_import([make_item("b", "b", ShopUnitType.category)], make_tree())
+
+
+def test_nested_moves_without_cycle():
+    # b поднимается в корень, a уходит под b, который был его ребёнком, цикла нет
+    items = [make_item("b", None, ShopUnitType.category), make_item("a", "b", ShopUnitType.category)]
+    validate_import(items, make_tree())
+
+
+def test_parent_is_offer():
+    with pytest.raises(InvalidImport, match="родителя"):
+        validate_import([make_item("x", "o1", ShopUnitType.offer, 10)], make_tree())
@@ -0,0 +1,107 @@
+"""
+Детерминированный генератор синтетического каталога для бенчмарков: при тех же параметрах и seed
+получаются те же id, иерархия, цены и даты, поэтому прогоны на разных версиях сравнимы
+"""
+import random
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Iterator
+
+SHAPES = ("wide", "deep", "skewed")
+START_DATE = datetime(2022, 2, 1, 12)
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
+DEEP_CHAIN_LENGTH = 50  # Глубина цепочек категорий в форме deep
+SKEW_EXPONENT = 1.1  # Показатель распределения Ципфа товаров по категориям в форме skewed
+
+
+@dataclass
+class Catalog:
+    categories: list[tuple[str, str | None]]  # (id, parentId), родитель всегда раньше детей, первая - корень
+    offers: list[tuple[str, str, int]]  # (id, parentId, price)
+
+
+def make_id(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def format_date(date: datetime) -> str:
+    return date.strftime(DATE_FORMAT)
+
+
+def make_category_parents(count: int, shape: str, rng: random.Random) -> list[int | None]:
+    """
+    Индексы родителей категорий:
+    wide - все категории прямо в корне, deep - цепочки по DEEP_CHAIN_LENGTH уровней от корня,
+    skewed - случайное дерево с предпочтительным присоединением, где у крупных категорий больше детей
+    """
+    parents: list[int | None] = [None]
+    attach: list[int] = [0]  # Категория встречается здесь 1 + число её детей раз
+    for i in range(1, count):
+        if shape == "wide":
+            parent = 0
+        elif shape == "deep":
+            parent = 0 if i % DEEP_CHAIN_LENGTH == 1 else i - 1
+        else:
+            parent = rng.choice(attach)
+            attach += [parent, i]
+        parents.append(parent)
+    return parents
+
+
+def generate_catalog(offers: int, shape: str = "wide", seed: int = 0, categories: int | None = None) -> Catalog:
+    """
+    Каталог из offers товаров и categories категорий (по умолчанию корень из числа товаров).
+    В wide и deep товары распределены по категориям равномерно,
+    в skewed - по Ципфу: большая часть товаров в нескольких категориях
+    """
+    if shape not in SHAPES:
+        raise ValueError(f"Unknown shape: {shape}")
+    rng = random.Random(seed)
+    count: int = categories or max(1, int(offers ** 0.5))
+    category_ids: list[str] = [make_id(rng) for _ in range(count)]
+    parents: list[int | None] = make_category_parents(count, shape, rng)
+    catalog = Catalog(
+        categories=[(category_ids[i], category_ids[parent] if parent is not None else None)
+                    for i, parent in enumerate(parents)],
+        offers=[]
+    )
+
+    weights: list[float] | None = None
+    if shape == "skewed":
+        ranks: list[int] = list(range(1, count + 1))
+        rng.shuffle(ranks)
+        weights = [1 / rank ** SKEW_EXPONENT for rank in ranks]
+    placement: list[str] = rng.choices(category_ids, weights=weights, k=offers)
+    catalog.offers = [(make_id(rng), parent, rng.randint(1, 100000)) for parent in placement]
+    return catalog
+
+
+def make_category_item(category: tuple[str, str | None], number: int) -> dict[str, Any]:
+    return {"type": "CATEGORY", "name": f"Категория {number}", "id": category[0], "parentId": category[1]}
+
+
+def make_offer_item(offer: tuple[str, str, int], number: int) -> dict[str, Any]:
+    return {"type": "OFFER", "name": f"Товар {number}", "id": offer[0], "parentId": offer[1], "price": offer[2]}
+
+
+def iter_items(catalog: Catalog) -> Iterator[dict[str, Any]]:
+    """Все юниты каталога в формате ShopUnitImport, категории раньше товаров"""
+    for number, category in enumerate(catalog.categories):
+        yield make_category_item(category, number)
+    for number, offer in enumerate(catalog.offers):
+        yield make_offer_item(offer, number)
+
+
+def make_import_batches(catalog: Catalog, batch_size: int = 1000,
+                        start: datetime = START_DATE) -> Iterator[dict[str, Any]]:
+    """Тела /imports по batch_size юнитов, у каждой следующей пачки updateDate на секунду позже"""
+    batch: list[dict[str, Any]] = []
+    number: int = 0
+    for item in iter_items(catalog):
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield {"items": batch, "updateDate": format_date(start + timedelta(seconds=number))}
+            batch, number = [], number + 1
+    if batch:
+        yield {"items": batch, "updateDate": format_date(start + timedelta(seconds=number))}
@@ -0,0 +1,284 @@
+"""
+Нагрузочный бенчмарк API на синтетическом каталоге из benchmarks.generator.
+Загружает каталог через /imports (или одним /imports/stream), затем выполняет заранее сгенерированную
+по seed смешанную нагрузку из /nodes, /sales, /node/{id}/statistic, /imports и /delete
+и печатает по каждой ручке пропускную способность, p50/p99 задержки и число SQL запросов (заголовок X-Query-Count).
+Запуск из корня репозитория на пустой БД: python -m benchmarks.run --offers 100000 --shape skewed --start-server
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Iterator
+
+from .generator import SHAPES, START_DATE, Catalog, generate_catalog, make_import_batches, iter_items, format_date
+
+DEFAULT_MIX = "nodes=40,statistic=25,sales=15,imports=15,delete=5"
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "MegaMarket")
+SERVER_START_TIMEOUT = 60  # Сколько секунд ждать, пока запущенный сервер начнёт отвечать
+
+
+@dataclass
+class Operation:
+    endpoint: str  # Имя ручки в отчёте
+    method: str
+    path: str
+    body: bytes | None = None
+    content_type: str = "application/json"
+
+
+@dataclass
+class EndpointStats:
+    latencies: list[float] = field(default_factory=list)
+    queries: list[int] = field(default_factory=list)
+    errors: int = 0
+
+
+class Client:
+    """HTTP клиент с keep-alive соединением на каждый поток"""
+
+    def __init__(self, url: str):
+        parsed = urllib.parse.urlsplit(url)
+        self.host: str = parsed.hostname
+        self.port: int = parsed.port or 80
+        self.local = threading.local()
+
+    def request(self, operation: Operation) -> tuple[int, int | None, float]:
+        """Выполняет запрос и возвращает статус, X-Query-Count и задержку в секундах"""
+        connection: http.client.HTTPConnection | None = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout=600)
+        headers: dict[str, str] = {"Content-Type": operation.content_type} if operation.body is not None else {}
+        started: float = time.perf_counter()
+        try:
+            connection.request(operation.method, operation.path, body=operation.body, headers=headers,
+                               encode_chunked=not isinstance(operation.body, (bytes, type(None))))
+            response = connection.getresponse()
+            response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            self.local.connection = None
+            raise
+        latency: float = time.perf_counter() - started
+        queries: str | None = response.getheader("X-Query-Count")
+        return response.status, int(queries) if queries is not None else None, latency
+
+
+def start_server(url: str) -> subprocess.Popen:
+    """
+    Запуск gunicorn из MegaMarket на адресе url с заголовком X-Query-Count, который по умолчанию выключен,
+    и ожидание, пока сервер начнёт отвечать
+    """
+    parsed = urllib.parse.urlsplit(url)
+    env: dict[str, str] = {**os.environ, "METRICS_QUERY_COUNT_HEADER": "true",
+                           "BIND": f"{parsed.hostname}:{parsed.port or 80}"}
+    server = subprocess.Popen(["gunicorn", "main:app"], cwd=SERVER_DIR, env=env)
+    deadline: float = time.monotonic() + SERVER_START_TIMEOUT
+    while True:
+        try:
+            with urllib.request.urlopen(f"{url}/metrics", timeout=1):
+                return server
+        except (urllib.error.URLError, OSError):
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.terminate()
+                raise RuntimeError(f"Server did not start on {url}")
+            time.sleep(0.5)
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights: dict[str, float] = {}
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        if name not in ("nodes", "statistic", "sales", "imports", "delete"):
+            raise ValueError(f"Unknown endpoint in mix: {name}")
+        weights[name] = float(weight)
+    return weights
+
+
+def make_workload(catalog: Catalog, args: argparse.Namespace) -> list[Operation]:
+    """
+    Смешанная нагрузка из args.requests запросов в пропорциях args.mix.
+    Удаляются только товары из отдельного резерва, поэтому остальные запросы не попадают на удалённые юниты
+    """
+    rng = random.Random(args.seed + 1)
+    weights: dict[str, float] = parse_mix(args.mix)
+    kinds: list[str] = rng.choices(list(weights), weights=list(weights.values()), k=args.requests)
+    deletes: int = min(kinds.count("delete"), len(catalog.offers) // 2)
+    deletable: list[tuple[str, str, int]] = catalog.offers[len(catalog.offers) - deletes:]
+    offers: list[tuple[str, str, int]] = catalog.offers[:len(catalog.offers) - deletes]
+    clock: Iterator[int] = itertools.count(1)  # Даты нагрузки идут после дат загрузки, по минуте на изменение
+    load_end: datetime = START_DATE + timedelta(days=1)
+    date_start: str = format_date(START_DATE - timedelta(days=1))
+
+    workload: list[Operation] = []
+    for kind in kinds:
+        date: str = format_date(load_end + timedelta(minutes=next(clock)))
+        if kind == "nodes":
+            category_id: str = rng.choice(catalog.categories)[0]
+            workload.append(Operation("nodes", "GET", f"/nodes/{category_id}"))
+        elif kind == "statistic":
+            offer_id: str = rng.choice(offers)[0]
+            workload.append(Operation("statistic", "GET",
+                                      f"/node/{offer_id}/statistic?dateStart={date_start}&dateEnd={date}"))
+        elif kind == "sales":
+            workload.append(Operation("sales", "GET", f"/sales?date={date}&limit={args.page_limit}"))
+        elif kind == "imports":
+            items: list[dict[str, Any]] = [
+                {"type": "OFFER", "name": "Обновлённый товар", "id": offer[0], "parentId": offer[1],
+                 "price": rng.randint(1, 100000)}
+                for offer in rng.sample(offers, min(args.update_size, len(offers)))
+            ]
+            workload.append(Operation("imports", "POST", "/imports",
+                                      json.dumps({"items": items, "updateDate": date}).encode()))
+        elif deletable:
+            workload.append(Operation("delete", "DELETE", f"/delete/{deletable.pop()[0]}?date={date}"))
+    return workload
+
+
+def run_operations(client: Client, operations: list[Operation],
+                   concurrency: int) -> tuple[dict[str, EndpointStats], float]:
+    """Выполняет запросы в concurrency потоков, возвращает статистику по ручкам и общее время"""
+    stats: dict[str, EndpointStats] = {}
+    lock = threading.Lock()
+
+    def execute(operation: Operation) -> None:
+        try:
+            status, queries, latency = client.request(operation)
+        except (http.client.HTTPException, OSError):
+            status, queries, latency = 0, None, 0.0
+        with lock:
+            endpoint: EndpointStats = stats.setdefault(operation.endpoint, EndpointStats())
+            if status != 200:
+                endpoint.errors += 1
+                return
+            endpoint.latencies.append(latency)
+            if queries is not None:
+                endpoint.queries.append(queries)
+
+    started: float = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(execute, operations))
+    return stats, time.perf_counter() - started
+
+
+def iter_ndjson_body(catalog: Catalog) -> Iterator[bytes]:
+    lines: list[bytes] = []
+    for item in iter_items(catalog):
+        lines.append(json.dumps(item).encode() + b"\n")
+        if len(lines) == 1000:
+            yield b"".join(lines)
+            lines = []
+    if lines:
+        yield b"".join(lines)
+
+
+def load_catalog(client: Client, catalog: Catalog, args: argparse.Namespace) -> tuple[dict[str, EndpointStats], float]:
+    """Загрузка каталога по порядку пачек в один поток: пачке нужны родители из предыдущих"""
+    if args.stream:
+        path: str = f"/imports/stream?updateDate={format_date(START_DATE)}"
+        operations: list[Operation] = [Operation("load stream", "POST", path, iter_ndjson_body(catalog),
+                                                 "application/x-ndjson")]
+    else:
+        operations = [Operation("load imports", "POST", "/imports", json.dumps(batch).encode())
+                      for batch in make_import_batches(catalog, args.batch_size)]
+    return run_operations(client, operations, 1)
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Перцентиль по ближайшему рангу"""
+    ordered: list[float] = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(q * len(ordered) + 0.5) - 1))]
+
+
+def summarize(stats: dict[str, EndpointStats], elapsed: float) -> dict[str, dict[str, Any]]:
+    report: dict[str, dict[str, Any]] = {}
+    for endpoint, endpoint_stats in sorted(stats.items()):
+        latencies: list[float] = endpoint_stats.latencies
+        queries: list[int] = endpoint_stats.queries
+        report[endpoint] = {
+            "requests": len(latencies) + endpoint_stats.errors,
+            "errors": endpoint_stats.errors,
+            "rps": len(latencies) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 0.5) * 1000 if latencies else None,
+            "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+            "queries_avg": sum(queries) / len(queries) if queries else None,
+            "queries_max": max(queries) if queries else None
+        }
+    return report
+
+
+def print_report(title: str, report: dict[str, dict[str, Any]], elapsed: float) -> None:
+    print(f"\n{title}: {elapsed:.2f} s")
+    print(f"{'endpoint':<14}{'requests':>10}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p99 ms':>10}"
+          f"{'queries avg':>13}{'queries max':>13}")
+    for endpoint, row in report.items():
+        cells: list[str] = [f"{row[key]:.2f}" if row[key] is not None else "-"
+                            for key in ("rps", "p50_ms", "p99_ms", "queries_avg")]
+        print(f"{endpoint:<14}{row['requests']:>10}{row['errors']:>8}{cells[0]:>10}{cells[1]:>10}{cells[2]:>10}"
+              f"{cells[3]:>13}{row['queries_max'] if row['queries_max'] is not None else '-':>13}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load benchmark of the MegaMarket API on a synthetic catalog")
+    parser.add_argument("--url", default="http://localhost:80")
+    parser.add_argument("--shape", choices=SHAPES, default="wide")
+    parser.add_argument("--offers", type=int, default=10000)
+    parser.add_argument("--categories", type=int, default=None, help="default: square root of --offers")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=1000, help="units per /imports request while loading")
+    parser.add_argument("--stream", action="store_true", help="load the catalog with one /imports/stream request")
+    parser.add_argument("--skip-load", action="store_true", help="the catalog with these parameters is already loaded")
+    parser.add_argument("--requests", type=int, default=2000, help="requests in the mixed workload")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"endpoint weights, default: {DEFAULT_MIX}")
+    parser.add_argument("--update-size", type=int, default=100, help="offers per /imports request in the workload")
+    parser.add_argument("--page-limit", type=int, default=100, help="limit of /sales pages")
+    parser.add_argument("--json", dest="json_path", help="also write the report to this file")
+    parser.add_argument("--start-server", action="store_true",
+                        help="start gunicorn from MegaMarket on --url with the X-Query-Count header enabled")
+    args = parser.parse_args()
+
+    server: subprocess.Popen | None = start_server(args.url) if args.start_server else None
+    try:
+        run_benchmark(args)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+def run_benchmark(args: argparse.Namespace) -> None:
+    catalog: Catalog = generate_catalog(args.offers, args.shape, args.seed, args.categories)
+    client = Client(args.url)
+    result: dict[str, Any] = {"parameters": vars(args)}
+    if not args.skip_load:
+        stats, elapsed = load_catalog(client, catalog, args)
+        units: int = len(catalog.categories) + len(catalog.offers)
+        result["load"] = {"seconds": elapsed, "units_per_second": units / elapsed,
+                          "endpoints": summarize(stats, elapsed)}
+        print_report(f"Load of {len(catalog.categories)} categories and {len(catalog.offers)} offers ({args.shape})",
+                     result["load"]["endpoints"], elapsed)
+    stats, elapsed = run_operations(client, make_workload(catalog, args), args.concurrency)
+    result["workload"] = {"seconds": elapsed, "endpoints": summarize(stats, elapsed)}
+    print_report(f"Mixed workload of {args.requests} requests, concurrency {args.concurrency}",
+                 result["workload"]["endpoints"], elapsed)
+    if all(row["queries_avg"] is None for row in result["workload"]["endpoints"].values()):
+        print("\nNo X-Query-Count headers: start the server with METRICS_QUERY_COUNT_HEADER=true or use --start-server")
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 # encoding=utf8
 
+import base64
 import json
 import re
 import subprocess
@@ -349,6 +350,40 @@ def test_stats():
     print("Test stats passed.")
 
 
+def test_cursors():
+    sales_params = {"date": "2022-02-08T15:00:00.000Z", "limit": 1}
+    stats_params = {"dateStart": "2022-02-01T00:00:00.000Z", "dateEnd": "2022-02-09T00:00:00.000Z", "limit": 1}
+    status, response = request(f"/sales?{urllib.parse.urlencode(sales_params)}", json_response=True)
+    assert status == 200, f"Expected HTTP status code 200, got {status}"
+    sales_cursor = response["nextCursor"]
+    status, response = request(f"/node/{ROOT_ID}/statistic?{urllib.parse.urlencode(stats_params)}",
+                               json_response=True)
+    assert status == 200, f"Expected HTTP status code 200, got {status}"
+    stats_cursor = response["nextCursor"]
+    status, response = request(f"/nodes/{ROOT_ID}?limit=1", json_response=True)
+    assert status == 200, f"Expected HTTP status code 200, got {status}"
+    nodes_cursor = response["nextCursor"]
+    assert sales_cursor is not None and stats_cursor is not None and nodes_cursor is not None, \
+        "Expected next page cursors"
+    status, response = request(f"/nodes/{ROOT_ID}?limit=1&cursor={nodes_cursor}", json_response=True)
+    assert status == 200, f"Expected HTTP status code 200, got {status}"
+
+    naive_cursor = base64.urlsafe_b64encode(
+        json.dumps(["2022-02-02T12:00:00", "863e1a7a-1304-42ae-943b-179184c077e3"]).encode()).decode()
+    for cursor in [stats_cursor, naive_cursor, "not-a-cursor"]:
+        params = urllib.parse.urlencode({**sales_params, "cursor": cursor})
+        status, _ = request(f"/sales?{params}")
+        assert status == 400, f"Expected HTTP status code 400 for /sales cursor {cursor}, got {status}"
+    for cursor in [sales_cursor, naive_cursor, "not-a-cursor"]:
+        params = urllib.parse.urlencode({**stats_params, "after": cursor})
+        status, _ = request(f"/node/{ROOT_ID}/statistic?{params}")
+        assert status == 400, f"Expected HTTP status code 400 for /statistic cursor {cursor}, got {status}"
+    for cursor in [sales_cursor, ROOT_ID, "not-a-cursor"]:
+        status, _ = request(f"/nodes/{ROOT_ID}?{urllib.parse.urlencode({'limit': 1, 'cursor': cursor})}")
+        assert status == 400, f"Expected HTTP status code 400 for /nodes cursor {cursor}, got {status}"
+    print("Test cursors passed.")
+
+
 def test_delete():
     status, _ = request(f"/delete/{ROOT_ID}", method="DELETE")
     assert status == 200, f"Expected HTTP status code 200, got {status}"
@@ -364,6 +399,7 @@ def test_all():
     test_nodes()
     test_sales()
     test_stats()
+    test_cursors()
     test_delete()
 
 